@@ -0,0 +1,89 @@
+# SESSION TOKENS AND LOGIN THROTTLING
+#
+# bcrypt is deliberately slow, so the server avoids running it more than it
+# has to:
+#
+#   - after a password login the client gets a session token, an HMAC of its
+#     username and an expiry time signed with a server secret. A reconnect
+#     presents the token instead of the password; checking it costs one HMAC.
+#     Every node of a cluster must use the same secret.
+#   - password logins and signups take a token from a bucket per IP address
+#     and per username first. An empty bucket refuses the attempt before
+#     bcrypt runs, so nobody can make the server hash passwords for free.
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+SESSION_TOKEN_TTL = 12 * 60 * 60  # Seconds a session token stays valid
+
+def load_secret(path, env_var):
+    """The token signing secret: from env_var if set, else from path (created on first use)"""
+    secret = os.environ.get(env_var)
+    if secret:
+        return secret.encode()
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    secret = os.urandom(32)
+    # Only readable by the server's user
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+class TokenSigner:
+    def __init__(self, secret, ttl=SESSION_TOKEN_TTL):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _sign(self, username, expires):
+        return hmac.new(self.secret, f"{username}|{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, username):
+        """A token for username, formatted expiry.signature"""
+        expires = int(time.time()) + self.ttl
+        return f"{expires}.{self._sign(username, expires)}"
+
+    def verify(self, username, token):
+        """True if token was issued for username and has not expired"""
+        expires, _, signature = token.partition(".")
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(signature, self._sign(username, int(expires)))
+
+class RateLimiter:
+    """Token buckets by key: rate tokens per second, holding at most burst"""
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = {}  # {key: (tokens, time of the last update)}
+        self._pruned = 0.0  # When full buckets were last forgotten
+
+    def allow(self, key):
+        """Take one token from key's bucket; returns False if it is empty"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return False
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys and now - self._pruned >= 1:
+                self._prune(now)
+            return True
+
+    def _prune(self, now):
+        """Forget the buckets that have refilled; they behave like new ones (lock held)"""
+        self._pruned = now
+        full = [key for key, (tokens, updated) in self._buckets.items()
+                if tokens + (now - updated) * self.rate >= self.burst]
+        for key in full:
+            del self._buckets[key]
@@ -0,0 +1,40 @@
+# STARTUP BENCHMARK
+#
+# Launches the client cold, several times, and reports how long each launch
+# took to get the login window on screen, measured from process start (so
+# interpreter startup and imports count), plus when the TLS connection opened
+# in the background was ready. Needs a display; the server should be running
+# for the connection time to mean anything.
+#
+#   python bench_startup.py [runs]
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client.py")
+
+def launch():
+    """(ms until the login window showed, the client's own report) for one cold start"""
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, CLIENT, "--startup-benchmark"],
+                               stdout=subprocess.PIPE, text=True)
+    first = process.stdout.readline()  # Printed as soon as the login window is visible
+    shown = (time.perf_counter() - started) * 1000
+    report = [first.strip()] + [line.strip() for line in process.stdout]
+    if process.wait() != 0 or not first:
+        raise RuntimeError(f"client exited with status {process.returncode}")
+    return shown, report
+
+def main(runs):
+    times = []
+    for run in range(1, runs + 1):
+        shown, report = launch()
+        times.append(shown)
+        print(f"Run {run}: login window after {shown:.0f} ms ({'; '.join(report)})")
+    print(f"⏱️ Cold start to login window: min {min(times):.0f} ms, "
+          f"median {statistics.median(times):.0f} ms, max {max(times):.0f} ms over {runs} runs")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,249 @@
+# MESSAGE BUS
+#
+# Several server processes (nodes) can serve one chat. Each node delivers to
+# its own clients and publishes on a bus what the other nodes need: chat
+# messages, typing, presence and heartbeats. Bus messages are binary frames
+# (see protocol.py) whose header is "KIND|origin node|..." and whose raw
+# bytes carry the payload.
+#
+# Backends, chosen by address:
+#   local://          in-process; every LocalBus on the same LocalHub sees the
+#                     others (a single node, or several nodes in one process)
+#   tcp://host:port   a broker reached over TCP
+#   unix:///path      a broker reached over a Unix socket
+#
+# The broker is this file: python bus.py tcp://127.0.0.1:6000
+# It forwards every frame to every other node, and tells the remaining
+# nodes NODE_DOWN|node as soon as a node's connection drops.
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+
+from metrics import metrics
+from protocol import FrameParser, BinaryMessage, encode_binary_frame
+
+BUS_RECONNECT_DELAY = 1.0  # Seconds between attempts to reach the broker
+BUS_QUEUE_SIZE = 10000  # Frames waiting for the broker before new ones are dropped
+
+def parse_address(address):
+    """(socket family, address) for a tcp:// or unix:// bus address"""
+    if address.startswith("tcp://"):
+        host, port = address[len("tcp://"):].rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://"):]
+    raise ValueError(f"unsupported bus address {address!r}")
+
+def dispatch(handler, message):
+    """Run the node's handler; one bad message must not stop the bus thread"""
+    try:
+        handler(message)
+    except Exception as e:
+        print(f"[ERROR] Bus message {message.header.split('|')[0]}: {str(e)}")
+
+def open_bus(address, node, on_connect):
+    """Create the bus for a node; on_connect() runs whenever it (re)joins the bus"""
+    if address == "local://":
+        return LocalBus(node, on_connect)
+    return BrokerBus(node, address, on_connect)
+
+class LocalHub:
+    """Connects the LocalBus instances of one process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buses = ()
+
+    def attach(self, bus):
+        with self._lock:
+            self._buses = self._buses + (bus,)
+
+    def detach(self, bus):
+        with self._lock:
+            self._buses = tuple(b for b in self._buses if b is not bus)
+        self.publish(bus, encode_binary_frame(f"NODE_DOWN|{bus.node}", b""))
+
+    def peers(self, bus):
+        return [b for b in self._buses if b is not bus]
+
+    def publish(self, origin, frame):
+        for bus in self.peers(origin):
+            bus._inbox.put(frame)
+
+LOCAL_HUB = LocalHub()
+
+class LocalBus:
+    def __init__(self, node, on_connect, hub=LOCAL_HUB):
+        self.node = node
+        self.on_connect = on_connect
+        self.hub = hub
+        self._inbox = queue.Queue()
+
+    def start(self, handler):
+        """Deliver other nodes' messages to handler(BinaryMessage) on a bus thread"""
+        self.hub.attach(self)
+        threading.Thread(target=self._run, args=(handler,), name="bus", daemon=True).start()
+        self.on_connect()
+
+    def publish(self, header, data=b""):
+        if self.hub.peers(self):  # Nobody to tell when running as a single node
+            metrics.incr("bus_published")
+            self.hub.publish(self, encode_binary_frame(header, data))
+
+    def close(self):
+        self.hub.detach(self)
+
+    def _run(self, handler):
+        parser = FrameParser()
+        while True:
+            parser.feed(self._inbox.get())
+            for message in parser.messages():
+                metrics.incr("bus_received")
+                dispatch(handler, message)
+
+class BrokerBus:
+    def __init__(self, node, address, on_connect):
+        self.node = node
+        self.address = address
+        self.on_connect = on_connect
+        self._family, self._sockaddr = parse_address(address)
+        self._outbox = queue.Queue(maxsize=BUS_QUEUE_SIZE)
+        self._sock = None
+        self._closed = False
+
+    def start(self, handler):
+        """Deliver other nodes' messages to handler(BinaryMessage) on a bus thread"""
+        threading.Thread(target=self._run, args=(handler,), name="bus", daemon=True).start()
+        threading.Thread(target=self._write_loop, name="bus-writer", daemon=True).start()
+
+    def publish(self, header, data=b""):
+        if self._sock is None:
+            return  # Not connected; the other nodes resync when we are back
+        try:
+            self._outbox.put_nowait(encode_binary_frame(header, data))
+            metrics.incr("bus_published")
+        except queue.Full:
+            metrics.incr("bus_dropped")
+
+    def close(self):
+        self._closed = True
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)  # Wakes the reader; the broker announces NODE_DOWN
+            except OSError:
+                pass
+            sock.close()
+
+    def _run(self, handler):
+        while not self._closed:
+            try:
+                sock = socket.socket(self._family, socket.SOCK_STREAM)
+                sock.connect(self._sockaddr)
+                sock.sendall(encode_binary_frame(f"HELLO|{self.node}", b""))
+            except OSError as e:
+                print(f"⚠️ Message bus {self.address} unreachable: {e}")
+                time.sleep(BUS_RECONNECT_DELAY)
+                continue
+            print(f"🔗 Joined message bus {self.address} as node {self.node}")
+            self._sock = sock
+            self.on_connect()
+            parser = FrameParser()
+            try:
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    parser.feed(data)
+                    for message in parser.messages():
+                        metrics.incr("bus_received")
+                        dispatch(handler, message)
+            except OSError:
+                pass
+            self._sock = None
+            sock.close()
+            if self._closed:
+                return
+            print(f"⚠️ Lost message bus {self.address}; reconnecting")
+            time.sleep(BUS_RECONNECT_DELAY)
+
+    def _write_loop(self):
+        while True:
+            frame = self._outbox.get()
+            sock = self._sock
+            if sock is None:
+                continue  # Dropped; the other nodes resync when we are back
+            try:
+                sock.sendall(frame)
+            except OSError:
+                pass  # The reader notices and reconnects
+
+def run_broker(address):
+    """Forward every node's frames to every other node, forever"""
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_UNIX and os.path.exists(sockaddr):
+        os.remove(sockaddr)
+    server = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(sockaddr)
+    server.listen()
+    print(f"✅ Message bus broker listening on {address}")
+
+    lock = threading.Lock()
+    peers = {}  # {socket: (node, send lock)}
+
+    def forward(frame, origin):
+        with lock:
+            targets = [(sock, send_lock) for sock, (_, send_lock) in peers.items() if sock is not origin]
+        for sock, send_lock in targets:
+            try:
+                with send_lock:
+                    sock.sendall(frame)
+            except OSError:
+                pass  # Its own thread notices and cleans up
+
+    def serve(sock):
+        parser = FrameParser()
+        node = None
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                parser.feed(data)
+                for message in parser.messages():
+                    if not isinstance(message, BinaryMessage):
+                        continue
+                    if node is None:
+                        # Format: HELLO|node, always the first frame
+                        node = message.header.split("|")[1]
+                        with lock:
+                            peers[sock] = (node, threading.Lock())
+                        print(f"🔗 Node {node} joined")
+                        continue
+                    forward(message.frame, sock)
+        except (OSError, IndexError):
+            pass
+        finally:
+            with lock:
+                peers.pop(sock, None)
+            sock.close()
+            if node is not None:
+                print(f"❌ Node {node} left")
+                forward(encode_binary_frame(f"NODE_DOWN|{node}", b""), None)
+
+    try:
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=serve, args=(sock,), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\nShutting down broker...")
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    run_broker(sys.argv[1] if len(sys.argv) > 1 else "tcp://127.0.0.1:6000")
@@ -1,47 +1,228 @@
 # CLIENT CODE (c2_.py)
+import time
+STARTED = time.perf_counter()  # Startup is measured from here (--startup-benchmark)
 import socket
 import threading
+import queue
+import functools
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, simpledialog, filedialog, ttk
-import bcrypt
-import base64
 import os
-from pymongo import MongoClient
-import json
 from datetime import datetime
-import time
-import ssl  # Add SSL support
+from collections import OrderedDict, deque
+import argparse
+from protocol import FrameParser, BinaryMessage, Compressor, encode_frame, encode_binary_frame, available_codecs
+from rooms import ROOM_PREFIX
+
+# The client needs no database: the server handles logins and storage. To
+# get the login window up quickly, modules only some code paths need (ssl,
+# json, hashlib, tempfile, base64, shutil, uuid, random) are imported where
+# they are used, and the TLS connection is opened on a background thread
+# while the user types their credentials. The server closes connections that
+# have not logged in after its LOGIN_TIMEOUT (10 s), so an older one is
+# replaced by a fresh connection, which resumes its TLS session.
+PRECONNECT_MAX_AGE = 8  # Seconds a connection opened in advance is used for the login
+
+# File uploads stream from disk on a worker thread. The server answers every
+# binary chunk with FILE_ACK; at most FILE_WINDOW_BYTES may be unacknowledged
+# at once, and the chunk size follows the measured throughput. Chunk sizes are
+# multiples of FILE_CHUNK_MIN (itself a multiple of 3), so the base64 the server
+# sends legacy clients for each chunk concatenates into valid base64.
+FILE_CHUNK_MIN = 12 * 1024
+FILE_CHUNK_MAX = 384 * 1024
+FILE_CHUNK_SECONDS = 0.05        # Aim for chunks that take about this long to send
+FILE_WINDOW_BYTES = 1024 * 1024  # Unacknowledged bytes allowed in flight
+FILE_ACK_TIMEOUT = 30            # Seconds to wait for the server before giving up
+MAX_FILE_SIZE = 1024 * 1024 * 1024  # Largest file the server's store accepts (server.MAX_FILE_SIZE)
+
+# Incoming files are written chunk by chunk into a .part file here, then
+# checked against the sender's SHA-256 and renamed; nothing is kept in memory.
+# Files from the server's store are fetched FILE_DOWNLOAD_WINDOW bytes per
+# FILE_FETCH, with two requests outstanding; a .part left by an interrupted
+# download is resumed where it stopped.
+RECEIVED_DIR_NAME = "cryptochat_received"
+FILE_DOWNLOAD_WINDOW = 512 * 1024
+
+def received_dir():
+    """The directory incoming files are written to, created on first use"""
+    import tempfile
+    path = os.path.join(tempfile.gettempdir(), RECEIVED_DIR_NAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# A lost connection is retried after a random delay of up to
+# RECONNECT_BASE_DELAY seconds, doubling per failed attempt up to
+# RECONNECT_MAX_DELAY, so clients cut off together do not return in lockstep.
+# Chat messages carry a client-chosen id and stay in an outbox until the
+# server answers MSG_ACK; whatever is left is resent after reconnecting, and
+# the server drops ids it has already seen.
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+# Tk widgets may only be touched from the Tk thread. The network thread
+# queues its UI updates instead (ChatClient.ui, display_message) and the Tk
+# loop applies them every UI_TICK_MS: chat lines that arrived in between are
+# inserted with one insert and one scroll, however many there are.
+UI_TICK_MS = 50
+UI_BATCH_MAX = 2000  # Queued updates applied per tick before the window gets to redraw
+
+# chat_area holds at most CHAT_MAX_LINES lines (--scrollback); beyond that
+# the oldest CHAT_EVICT_LINES go in one delete. Scrolling to the top fetches
+# the page before the oldest message shown (HISTORY_REQUEST|message id). If
+# that page takes chat_area over the limit, the newest lines go instead, and
+# live lines are held back until the view is scrolled down to the bottom.
+CHAT_MAX_LINES = 5000
+CHAT_EVICT_LINES = 1000
+
+class FileUpload:
+    """Resume point, send window and throughput estimate for one outgoing file"""
+
+    def __init__(self):
+        self._acked = threading.Condition()
+        self.resume_offset = None  # Bytes the server already has, from FILE_RESUME
+        self.error = None  # Reason from FILE_FAILED
+        self.in_flight = {}  # {chunk_num: size}
+        self.in_flight_bytes = 0
+        self.acked_bytes = 0
+        self.started = time.monotonic()
+        self.interrupted = False  # The connection dropped during this attempt
+        self.generation = 0  # Bumped by restart() once reconnected
+        self.attempt = 0  # Generation the current attempt started in
+
+    def resume(self, offset):
+        with self._acked:
+            self.resume_offset = offset
+            self._acked.notify()
+
+    def fail(self, reason):
+        with self._acked:
+            self.error = reason
+            self._acked.notify()
+
+    def interrupt(self):
+        """The connection dropped; the attempt in progress stops with ConnectionError"""
+        with self._acked:
+            self.interrupted = True
+            self._acked.notify()
+
+    def restart(self):
+        """Reconnected: an interrupted upload offers the file again and continues from FILE_RESUME"""
+        with self._acked:
+            if not self.interrupted:
+                return  # Started on the new connection
+            self.interrupted = False
+            self.resume_offset = None
+            self.in_flight = {}
+            self.in_flight_bytes = 0
+            self.generation += 1
+            self._acked.notify()
+
+    def begin_attempt(self):
+        with self._acked:
+            self.attempt = self.generation
+
+    def wait_for_restart(self):
+        """Block until reconnected; raises OSError if the client gave up instead"""
+        with self._acked:
+            if self.generation == self.attempt:
+                self.interrupted = True  # A send failed before the receive thread noticed
+            self._acked.wait_for(lambda: self.generation != self.attempt or self.error)
+            if self.error:
+                raise OSError(self.error)
+
+    def wait_for_resume(self):
+        """Block until the server says where to start; returns the offset"""
+        self._wait(lambda: self.resume_offset is not None)
+        return self.resume_offset
+
+    def _wait(self, predicate):
+        with self._acked:
+            lost = lambda: self.interrupted or self.generation != self.attempt
+            if not self._acked.wait_for(lambda: predicate() or self.error or lost(), FILE_ACK_TIMEOUT):
+                raise TimeoutError("server stopped responding to the upload")
+            if self.error:
+                raise OSError(self.error)
+            if lost():
+                raise ConnectionError("connection lost")
+
+    def sent(self, chunk_num, size):
+        with self._acked:
+            self.in_flight[chunk_num] = size
+            self.in_flight_bytes += size
+
+    def ack(self, chunk_num):
+        with self._acked:
+            size = self.in_flight.pop(chunk_num, 0)
+            self.in_flight_bytes -= size
+            self.acked_bytes += size
+            self._acked.notify()
+
+    def wait_for_window(self, limit):
+        """Block until fewer than limit bytes are unacknowledged"""
+        self._wait(lambda: self.in_flight_bytes < limit)
+
+    def chunk_size(self):
+        """Next chunk size, sized to take about FILE_CHUNK_SECONDS at the current rate"""
+        elapsed = time.monotonic() - self.started
+        if not self.acked_bytes or elapsed <= 0:
+            return FILE_CHUNK_MIN
+        size = int(self.acked_bytes / elapsed * FILE_CHUNK_SECONDS)
+        size -= size % FILE_CHUNK_MIN
+        return max(FILE_CHUNK_MIN, min(FILE_CHUNK_MAX, size))
 
 class ChatClient:
-    def __init__(self, root):
+    def __init__(self, root, max_lines=CHAT_MAX_LINES, startup_benchmark=False):
         self.root = root
         self.root.title("Enhanced Chat Room")
         self.root.configure(bg="#F0F0F0")
         self.typing = False
         self.dark_mode = False
         self.online_users = []
+        self.presence_seq = None  # Sequence number of the last presence update applied
+        self.tls_context = None  # Kept across connections; sessions only resume within one context
+        self.tls_session = None  # TLS session of the last connection, offered again on reconnect
+        self.session_token = None  # From SESSION_TOKEN; reconnects log in with it instead of the password
+        self.client_socket = None  # Until the first login succeeds
+        self.preconnected = None  # (TLS socket, time opened) from preconnect, not logged in yet
+        self.compressor = None  # Compressor for large frames, once the server agrees to one
         self.current_recipient = "Everyone"
+        self.send_lock = threading.Lock()  # Chat and file upload threads share the socket
+        self.uploads = {}  # {file_name: FileUpload} for files being sent
+        self.downloads = {}  # {sha256: download state} for files being fetched from the server
+        self.outbox = OrderedDict()  # {message id: MSG/PRIVATE text} not yet acknowledged by the server
+        self.joined_rooms = []  # Rooms this session is in, in Rooms panel order (network thread)
+        self.rejoining = set()  # Rooms being rejoined after a reconnect, already in the Rooms panel
+        self.ui_queue = queue.SimpleQueue()  # UI updates from other threads, applied by process_ui_queue
+        self.network_queue = queue.SimpleQueue()  # Work for the network thread, run by run_network_tasks
+        self.network_wake, self.network_waker = socket.socketpair()  # Wakes the network thread for it
+        self.network_wake.setblocking(False)
+        self.network_waker.setblocking(False)
+        # Scrollback (Tk thread)
+        self.max_lines = max_lines
+        self.chat_items = deque()  # [line count, message id or None] per entry of chat_area, oldest first
+        self.chat_lines = 0  # Lines in chat_area
+        self.oldest_id = None  # Id of the oldest message shown; older pages are fetched from there
+        self.more_history = True  # False once the server has nothing older
+        self.loading_older = None  # Id the last HISTORY_REQUEST|id asked before, until its page arrives
+        self.page = None  # [before id, lines, entries] of the page being put above chat_area
+        self.browsing = False  # True while the newest lines are trimmed off for older ones
+        self.held = deque(maxlen=max_lines)  # Live lines that arrived while browsing
+        self.closing = False  # Set when the window closes; stops reconnecting
+        self.startup_benchmark = startup_benchmark
         
         # Configure styles
         self.configure_styles()
         
-        # Try to connect to MongoDB
-        try:
-            self.client_mongo = MongoClient("mongodb://localhost:27017/", serverSelectionTimeoutMS=5000)
-            self.client_mongo.server_info()  # Will raise exception if connection fails
-            self.db = self.client_mongo["chat_app"]
-            self.users_collection = self.db["users"]
-            self.messages_collection = self.db["messages"]
-        except Exception as e:
-            messagebox.showerror("Database Error", f"Cannot connect to MongoDB: {str(e)}")
-            self.root.quit()
-            return
+        # Connect while the user types their credentials
+        self.preconnecting = threading.Thread(target=self.preconnect, daemon=True)
+        self.preconnecting.start()
 
         if not self.authenticate_user():
             self.root.quit()
             return
 
         self.setup_gui()
+        self.root.after(UI_TICK_MS, self.process_ui_queue)
         self.connect_to_server()
         
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
@@ -83,6 +264,8 @@ class ChatClient:
         self.file_btn.config(bg=self.current_theme["accent"])
         self.theme_btn.config(text="🌙" if not self.dark_mode else "☀️")
         self.users_list.config(bg=self.current_theme["entry_bg"], fg=self.current_theme["fg"])
+        self.rooms_list.config(bg=self.current_theme["entry_bg"], fg=self.current_theme["fg"])
+        self.room_entry.config(bg=self.current_theme["entry_bg"], fg=self.current_theme["fg"])
         self.search_entry.config(bg=self.current_theme["entry_bg"], fg=self.current_theme["fg"])
 
     def authenticate_user(self):
@@ -145,10 +328,25 @@ class ChatClient:
         # Set focus to username entry
         username_entry.focus_set()
         
+        if self.startup_benchmark:
+            auth_window.after_idle(self.report_startup, auth_window)
+        
         # Wait for the window to be destroyed
         self.root.wait_window(auth_window)
         return self.auth_result
 
+    def report_startup(self, auth_window):
+        """--startup-benchmark: print how long the login window and the connection took, then close"""
+        auth_window.wait_visibility()
+        auth_window.update_idletasks()
+        print(f"⏱️ Login window shown after {(time.perf_counter() - STARTED) * 1000:.0f} ms", flush=True)
+        self.preconnecting.join()
+        if self.preconnected is None:
+            print("⏱️ TLS connection failed", flush=True)
+        else:
+            print(f"⏱️ TLS connection ready after {(self.preconnected[1] - STARTED) * 1000:.0f} ms", flush=True)
+        auth_window.destroy()
+
     def setup_gui(self):
         # Main frame
         main_frame = tk.Frame(self.root, bg=self.current_theme["bg"])
@@ -237,6 +435,29 @@ class ChatClient:
         )
         self.theme_btn.pack(side=tk.LEFT, padx=2)
         
+        # Rooms
+        tk.Label(
+            right_panel, text="Rooms", bg=self.current_theme["bg"],
+            fg=self.current_theme["fg"], font=("Arial", 12, "bold")
+        ).pack(pady=(0, 5))
+        
+        room_frame = tk.Frame(right_panel, bg=self.current_theme["bg"])
+        room_frame.pack(fill=tk.X)
+        self.room_entry = tk.Entry(
+            room_frame, bg=self.current_theme["entry_bg"], fg=self.current_theme["fg"], width=12
+        )
+        self.room_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.room_entry.bind("<Return>", self.join_room)
+        tk.Button(room_frame, text="Join", command=self.join_room).pack(side=tk.LEFT, padx=2)
+        tk.Button(room_frame, text="Leave", command=self.leave_room).pack(side=tk.LEFT)
+        
+        self.rooms_list = tk.Listbox(
+            right_panel, bg=self.current_theme["entry_bg"], fg=self.current_theme["fg"],
+            selectbackground=self.current_theme["button_bg"], height=5
+        )
+        self.rooms_list.pack(fill=tk.X, pady=(5, 10))
+        self.rooms_list.bind("<<ListboxSelect>>", self.select_room)
+        
         # Users list
         tk.Label(
             right_panel, text="Online Users", bg=self.current_theme["bg"],
@@ -254,80 +475,263 @@ class ChatClient:
         
         # Status indicator
         self.status_label = tk.Label(
-            right_panel, text="Connected", fg="green", bg=self.current_theme["bg"]
+            right_panel, text="Connecting...", fg="orange", bg=self.current_theme["bg"]
         )
         self.status_label.pack(pady=5)
 
     def connect_to_server(self):
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        """Log in on the network thread, which then handles server messages.
+
+        The window is usable meanwhile; messages written before the login
+        completes wait in the outbox and go out right after it.
+        """
+        threading.Thread(target=self.receive_messages, daemon=True).start()
+
+    def log_in(self):
+        """The first login (network thread); returns False if it failed"""
+        try:
+            status = self.open_connection()
+        except Exception as e:
+            self.ui(self.quit_with_error, "Connection Error", f"❌ Cannot connect to the server: {str(e)}")
+            return False
+        if status == "LOGIN_THROTTLED":
+            self.ui(self.quit_with_error, "Authentication", "Too many login attempts. Try again later.")
+            return False
+        if status not in ["LOGIN_SUCCESS", "SIGNUP_SUCCESS", "WELCOME"]:
+            self.ui(self.quit_with_error, "Authentication", "Login or signup failed.")
+            return False
         
+        # Request message history
+        self.send_frame("HISTORY_REQUEST")
+        self.show_connected()
+        return True
+
+    def quit_with_error(self, title, message):
+        messagebox.showerror(title, message)
+        self.root.quit()
+
+    def dial(self):
+        """Open a TLS connection to the server, not logged in yet"""
+        import ssl
         # Wrap socket with SSL/TLS
-        context = ssl.create_default_context()
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE  # For self-signed certificates
+        if self.tls_context is None:
+            self.tls_context = ssl.create_default_context()
+            self.tls_context.check_hostname = False
+            self.tls_context.verify_mode = ssl.CERT_NONE  # For self-signed certificates
         
+        # Resuming the previous session skips the certificate exchange
+        sock = self.tls_context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), session=self.tls_session)
         try:
-            self.client_socket = context.wrap_socket(self.client_socket)
-            self.client_socket.connect(("127.0.0.1", 5001))
-            
-            auth_data = f"{self.username}||{self.password}"
-            self.client_socket.send(auth_data.encode())
+            sock.connect(("127.0.0.1", 5001))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def preconnect(self):
+        """Open the first connection while the login window is up (background thread)"""
+        try:
+            self.preconnected = (self.dial(), time.perf_counter())
+        except OSError as e:
+            print(f"Could not connect in advance: {str(e)}")  # The login tries again
+
+    def take_preconnected(self):
+        """The connection preconnect opened, if the server will still take a login on it"""
+        self.preconnecting.join()
+        preconnected, self.preconnected = self.preconnected, None
+        if preconnected is None:
+            return None
+        sock, opened = preconnected
+        if time.perf_counter() - opened < PRECONNECT_MAX_AGE:
+            return sock
+        sock.close()
+        return None
 
-            status = self.client_socket.recv(1024).decode()
+    def open_connection(self):
+        """Connect and log in; returns the server's answer to the login.
+
+        The new socket only replaces self.client_socket once the login has
+        succeeded, so nothing else is sent on it before the credentials.
+        """
+        sock = self.take_preconnected()
+        early = sock is not None
+        if not early:
+            sock = self.dial()
+        parser = FrameParser()
+        if self.session_token:
+            login = f"TOKEN|{self.username}|{self.session_token}"  # Spares the server a bcrypt check
+        else:
+            login = f"{self.username}||{self.password}"
+        try:
+            sock.sendall(encode_frame(login))
+            status = self.receive_frame(sock, parser)
+        except Exception:
+            sock.close()
+            if early:
+                return self.open_connection()  # The server gave up waiting for the login; start over
+            raise
+        if status not in ["LOGIN_SUCCESS", "SIGNUP_SUCCESS", "WELCOME"]:
+            sock.close()
+            if self.session_token and status == "LOGIN_FAILED":
+                # Expired, or signed by a server with another secret
+                self.session_token = None
+                return self.open_connection()
+            return status
+        
+        # TLS 1.3 session tickets follow the handshake; they have arrived by now
+        self.tls_session = sock.session
+        with self.send_lock:
+            self.client_socket, self.parser = sock, parser
+            # Uncompressed until the server answers which codec to use
+            self.compressor = None
+            sock.sendall(encode_frame(f"COMPRESS|{','.join(available_codecs())}"))
+            # Rejoin rooms, then resend what the server never acknowledged,
+            # before anything new can go out on the connection
+            self.rejoining = set(self.joined_rooms)
+            for room in self.rejoining:
+                sock.sendall(encode_frame(f"ROOM_JOIN|{room}|rejoin"))  # Without the history we already show
+            for message in list(self.outbox.values()):
+                sock.sendall(encode_frame(message))
+        return status
+
+    def show_connected(self):
+        if self.client_socket.session_reused:
+            self.ui(self.status_label.config, text="Connected (Secure, resumed)", fg="green")
+        else:
+            self.ui(self.status_label.config, text="Connected (Secure)", fg="green")
+
+    def reconnect(self):
+        """Reconnect with exponential backoff and jitter (receive thread).
+
+        Returns False if the window was closed or the login was refused.
+        """
+        limit = RECONNECT_BASE_DELAY
+        attempt = 0
+        while not self.closing:
+            import random
+            delay = random.uniform(0, limit)
+            limit = min(RECONNECT_MAX_DELAY, limit * 2)
+            attempt += 1
+            self.ui(self.status_label.config, text=f"Reconnecting (attempt {attempt})...", fg="orange")
+            time.sleep(delay)
+            if self.closing:
+                break
+            try:
+                status = self.open_connection()
+            except OSError as e:
+                print(f"Reconnect attempt {attempt} failed: {str(e)}")
+                continue
+            if status == "LOGIN_THROTTLED":
+                continue  # Too many logins from here right now; keep backing off
             if status not in ["LOGIN_SUCCESS", "SIGNUP_SUCCESS", "WELCOME"]:
-                messagebox.showerror("Authentication", "Login or signup failed.")
-                self.root.quit()
-                return
-            
-            # Request message history
-            self.client_socket.send("HISTORY_REQUEST".encode())
-            
-            # Start receiving messages
-            threading.Thread(target=self.receive_messages, daemon=True).start()
-            
-            # Update status
-            self.status_label.config(text="Connected (Secure)", fg="green")
-        except Exception as e:
-            messagebox.showerror("Connection Error", f"❌ Cannot connect to the server: {str(e)}")
-            self.root.quit()
+                self.ui(self.status_label.config, text="Disconnected (login refused)", fg="red")
+                return False
+            print(f"Reconnected after {attempt} attempts; resent {len(self.outbox)} messages")
+            self.show_connected()
+            return True
+        return False
+
+    def send_frame(self, message):
+        """Send one message to the server as a length-prefixed frame.
+
+        Returns False if the connection is down; the receive thread is then
+        already reconnecting.
+        """
+        try:
+            self.send_raw(encode_frame(message, compressor=self.compressor))
+            return True
+        except OSError:
+            return False
+
+    def send_raw(self, data):
+        """Send already-encoded frames without interleaving with other threads"""
+        with self.send_lock:
+            if self.client_socket is None:
+                raise ConnectionError("not logged in yet")
+            self.client_socket.sendall(data)
+
+    def receive_frame(self, sock, parser):
+        """Block until one complete frame arrives on sock and return its text.
+
+        Any further frames from the same read stay buffered in the parser
+        for receive_messages to pick up.
+        """
+        while True:
+            for message in parser.messages():
+                return message
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            parser.feed(data)
 
     def select_recipient(self, event):
         selection = self.users_list.curselection()
         if selection:
             self.current_recipient = self.users_list.get(selection[0])
             if self.current_recipient != "Everyone":
-                self.chat_area.config(state=tk.NORMAL)
-                self.chat_area.insert(tk.END, f"\n--- Private chat with {self.current_recipient} ---\n\n")
-                self.chat_area.config(state=tk.DISABLED)
-                self.chat_area.yview(tk.END)
+                self.write_chat([(f"\n--- Private chat with {self.current_recipient} ---\n", None, None)])
+
+    def select_room(self, event):
+        selection = self.rooms_list.curselection()
+        if selection:
+            self.switch_to_room(self.rooms_list.get(selection[0]))
+
+    def switch_to_room(self, room):
+        self.current_recipient = room
+        self.users_list.selection_clear(0, tk.END)
+        self.write_chat([(f"\n--- Room {room} ---\n", None, None)])
+
+    def left_room(self, room):
+        if self.current_recipient == room:
+            self.current_recipient = "Everyone"
+            self.users_list.selection_set(0)
+            self.display_message(f"SERVER: You left {room}")
+
+    def join_room(self, event=None):
+        room = self.room_entry.get().strip()
+        if room:
+            if not room.startswith(ROOM_PREFIX):
+                room = ROOM_PREFIX + room
+            self.send_frame(f"ROOM_JOIN|{room}")
+            self.room_entry.delete(0, tk.END)
+
+    def leave_room(self):
+        if self.current_recipient.startswith(ROOM_PREFIX):
+            self.send_frame(f"ROOM_LEAVE|{self.current_recipient}")
 
     def send_typing_status(self, event=None):
         if not self.typing and event.keysym not in ('Return', 'Escape', 'Tab'):
             self.typing = True
             typing_msg = f"TYPING|{self.username}|{self.current_recipient}|is typing..."
-            self.client_socket.send(typing_msg.encode())
+            self.send_frame(typing_msg)
             self.root.after(2000, self.reset_typing)
 
     def reset_typing(self):
         self.typing = False
         typing_msg = f"TYPING|{self.username}|{self.current_recipient}|"
-        self.client_socket.send(typing_msg.encode())
+        self.send_frame(typing_msg)
 
     def send_message(self, event=None):
         msg = self.msg_entry.get().strip()
         if msg:
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-            if self.current_recipient == "Everyone":
-                full_msg = f"MSG|{self.username}|Everyone|{msg}|{timestamp}"
+            import uuid
+            message_id = uuid.uuid4().hex
+            if self.current_recipient == "Everyone" or self.current_recipient.startswith(ROOM_PREFIX):
+                full_msg = f"MSG|{self.username}|{self.current_recipient}|{msg}|{timestamp}|{message_id}"
             else:
-                full_msg = f"PRIVATE|{self.username}|{self.current_recipient}|{msg}|{timestamp}"
+                full_msg = f"PRIVATE|{self.username}|{self.current_recipient}|{msg}|{timestamp}|{message_id}"
             
-            self.client_socket.send(full_msg.encode())
+            # Kept until the server acknowledges it; resent after a reconnect
+            self.outbox[message_id] = full_msg
+            self.send_frame(full_msg)
             
             # ✅ Display the message regardless of recipient
             if self.current_recipient == "Everyone":
                 self.display_message(f"You ({timestamp}): {msg}")
+            elif self.current_recipient.startswith(ROOM_PREFIX):
+                self.display_message(f"[{self.current_recipient}] You ({timestamp}): {msg}")
             else:
                 self.display_message(f"You to {self.current_recipient} ({timestamp}): {msg}")
             
@@ -344,9 +748,9 @@ class ChatClient:
             file_name = os.path.basename(file_path)
             file_size = os.path.getsize(file_path)
             
-            # Check if file is too large (10MB limit)
-            if file_size > 10 * 1024 * 1024:
-                messagebox.showerror("File Too Large", "File size exceeds 10MB limit.")
+            # Check if file is too large for the server's store
+            if file_size > MAX_FILE_SIZE:
+                messagebox.showerror("File Too Large", f"File size exceeds {MAX_FILE_SIZE // (1024 * 1024 * 1024)}GB limit.")
                 return
                 
             # Create progress bar with improved UI
@@ -391,209 +795,455 @@ class ChatClient:
             
             progress_window.update()
             
-            # Read and encode file
-            with open(file_path, "rb") as f:
-                file_data = base64.b64encode(f.read()).decode()
-            
-            # Send file info first
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            file_info = f"FILE_INFO|{self.username}|{recipient}|{file_name}|{len(file_data)}|{timestamp}"
-            self.client_socket.send(file_info.encode())
-            
-            status_label.config(text="Sending file...")
-            progress_window.update()
-            
-            # Wait for server acknowledgment
-            time.sleep(0.5)
+            status_label.config(text="Checking file...")
             
-            # Send file data in chunks
-            chunk_size = 4096
-            total_chunks = len(file_data) // chunk_size + (1 if len(file_data) % chunk_size else 0)
-            
-            for i in range(0, len(file_data), chunk_size):
-                chunk = file_data[i:i+chunk_size]
-                chunk_msg = f"FILE_CHUNK|{self.username}|{recipient}|{file_name}|{i//chunk_size}|{total_chunks}|{chunk}"
-                self.client_socket.send(chunk_msg.encode())
-                
-                # Update progress
-                progress["value"] = (i + len(chunk)) / len(file_data) * 100
+            def on_progress(sent):
+                progress["value"] = sent / file_size * 100 if file_size else 100
                 status_label.config(text=f"Sending: {progress['value']:.1f}% complete")
-                progress_window.update()
-                time.sleep(0.01)  # Small delay to prevent overwhelming the server
             
-            # Send file complete message
-            complete_msg = f"FILE_COMPLETE|{self.username}|{recipient}|{file_name}|{timestamp}"
-            self.client_socket.send(complete_msg.encode())
-            
-            # Show completion message
-            status_label.config(text="File sent successfully!")
-            progress_window.update()
+            def on_done(error):
+                if error:
+                    status_label.config(text=f"Sending failed: {error}")
+                    progress_window.after(3000, progress_window.destroy)
+                    return
+                
+                # Show completion message
+                progress["value"] = 100
+                status_label.config(text="File sent successfully!")
+                
+                # Close progress window after a delay
+                progress_window.after(1500, progress_window.destroy)
+                
+                # Display message in our own chat if private
+                if recipient == "Everyone":
+                    self.display_message(f"You sent a file to Everyone: {file_name}")
+                else:
+                    self.display_message(f"You sent a file to {recipient}: {file_name}")
             
-            # Close progress window after a delay
-            progress_window.after(1500, progress_window.destroy)
+            # Stream the file from a worker thread so the window stays responsive
+            threading.Thread(
+                target=self.stream_file,
+                args=(file_path, file_name, file_size, recipient, timestamp, on_progress, on_done),
+                daemon=True
+            ).start()
+
+    def stream_file(self, file_path, file_name, file_size, recipient, timestamp, on_progress, on_done):
+        """Upload a file into the server's file store (worker thread).
+
+        The server keeps files by SHA-256, so it is hashed first: FILE_OFFER
+        then tells the server what is coming, and FILE_RESUME answers how many
+        bytes it already has (all of them if anyone uploaded the file before).
+        Chunks are then sent from there as FILE_ACKs open the window.
+        """
+        upload = FileUpload()
+        self.uploads[file_name] = upload
+        error = None
+        try:
+            import hashlib
+            checksum = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    checksum.update(block)
             
-            # Display message in our own chat if private
-            if recipient == "Everyone":
-                self.display_message(f"You sent a file to Everyone: {file_name}")
-            else:
-                self.display_message(f"You sent a file to {recipient}: {file_name}")
+            offer = f"FILE_OFFER|{self.username}|{recipient}|{file_name}|{file_size}|{timestamp}|{checksum.hexdigest()}"
+            while True:
+                upload.begin_attempt()
+                try:
+                    self.send_upload(upload, offer, file_path, file_name, file_size, recipient, on_progress)
+                    break
+                except ConnectionError:
+                    # Offered again once reconnected; the server kept what it had
+                    upload.wait_for_restart()
+        except (OSError, TimeoutError) as e:
+            error = e
+        finally:
+            self.uploads.pop(file_name, None)
+        self.ui(on_done, error)
+
+    def send_upload(self, upload, offer, file_path, file_name, file_size, recipient, on_progress):
+        """One attempt at an upload, over the current connection (worker thread).
+
+        Raises ConnectionError if the connection drops meanwhile.
+        """
+        if not self.send_frame(offer):
+            raise ConnectionError("not connected to the server")
+        sent = upload.wait_for_resume()
+        self.ui(on_progress, sent)
+        
+        with open(file_path, "rb") as f:
+            f.seek(sent)
+            chunk_num = 0
+            while sent < file_size:
+                upload.wait_for_window(FILE_WINDOW_BYTES)
+                size = upload.chunk_size()
+                chunk = f.read(min(size, file_size - sent))
+                if not chunk:
+                    raise OSError("file shrank while it was being sent")
+                offset = sent
+                sent += len(chunk)
+                # Later chunks may differ in size; the last one carries the exact count
+                total_chunks = chunk_num + 1 + -(-(file_size - sent) // size)
+                chunk_header = f"FILE_CHUNK|{self.username}|{recipient}|{file_name}|{chunk_num}|{total_chunks}|{offset}"
+                upload.sent(chunk_num, len(chunk))
+                try:
+                    self.send_raw(encode_binary_frame(chunk_header, chunk, self.compressor))
+                except OSError as e:
+                    raise ConnectionError(str(e))
+                chunk_num += 1
+                self.ui(on_progress, sent)
+        upload.wait_for_window(1)
 
     def receive_messages(self):
-        file_data = {}  # To store file chunks
+        """Log in, then handle server messages until the window closes, reconnecting as needed"""
+        if not self.log_in():
+            self.stop_transfers()
+            return
+        while True:
+            self.resume_transfers()
+            self.receive_until_disconnected()
+            if self.closing or not self.reconnect():
+                self.stop_transfers()
+                return
+
+    def resume_transfers(self):
+        """Continue file transfers a disconnect cut off (receive thread, once logged in)"""
+        for digest, download in list(self.downloads.items()):
+            self.request_download_data(digest, download)
+        for upload in list(self.uploads.values()):
+            upload.restart()
+
+    def stop_transfers(self):
+        """No connection any more: give up on file transfers (receive thread)"""
+        for download in list(self.downloads.values()):
+            self.close_download(download)  # The .part file stays for a later Fetch
+        self.downloads.clear()
+        for upload in list(self.uploads.values()):
+            upload.fail("connection lost")
+
+    def receive_until_disconnected(self):
+        import select
+        file_data = {}  # Incoming file transfers, by "sender_filename"
         
         while True:
             try:
-                msg = self.client_socket.recv(65536).decode(errors="ignore")
-                if not msg:
+                self.run_network_tasks()
+                # Decrypted bytes already buffered would not wake select
+                if not self.client_socket.pending():
+                    readable, _, _ = select.select([self.client_socket, self.network_wake], [], [])
+                    if self.client_socket not in readable:
+                        continue
+                data = self.client_socket.recv(65536)
+                if not data:
                     break
                 
-                parts = msg.split("|")
-                msg_type = parts[0]
-                
-                if msg_type == "USERS_LIST":
-                    self.update_users_list(parts[1:])
-                
-                elif msg_type == "TYPING":
-                    sender = parts[1]
-                    recipient = parts[2]
-                    typing_text = parts[3]
-                    
-                    if (recipient == "Everyone" or recipient == self.username or sender == self.current_recipient):
-                        if typing_text:
-                            self.typing_label.config(text=f"{sender} {typing_text}")
-                        else:
-                            self.typing_label.config(text="")
-                
-                elif msg_type == "MSG":
-                    sender = parts[1]
-                    recipient = parts[2]
-                    content = parts[3]
-                    timestamp = parts[4]
-                    
-                    self.display_message(f"{sender} ({timestamp}): {content}")
-                
-                elif msg_type == "PRIVATE":
-                    sender = parts[1]
-                    recipient = parts[2]
-                    content = parts[3]
-                    timestamp = parts[4]
+                self.parser.feed(data)
+                for msg in self.parser.messages():
+                    self.handle_server_message(msg, file_data)
                     
-                    if recipient == self.username:
-                        self.display_message(f"[Private] {sender} ({timestamp}): {content}")
-                
-                elif msg_type == "HISTORY":
-                    # Format: HISTORY|json_data
-                    history_data = "|".join(parts[1:])
-                    try:
-                        messages = json.loads(history_data)
-                        for msg in messages:
-                            if msg["type"] == "message":
-                                if msg["recipient"] == "Everyone":
-                                    self.display_message(f"{msg['sender']} ({msg['timestamp']}): {msg['content']}")
-                                elif msg["recipient"] == self.username or msg["sender"] == self.username:
-                                    self.display_message(f"[Private] {msg['sender']} to {msg['recipient']} ({msg['timestamp']}): {msg['content']}")
-                            elif msg["type"] == "file":
-                                if msg["recipient"] == "Everyone":
-                                    self.display_message(f"{msg['sender']} sent a file: {msg['filename']}", is_file=True)
-                                elif msg["recipient"] == self.username or msg["sender"] == self.username:
-                                    self.display_message(f"[Private] {msg['sender']} sent a file to {msg['recipient']}: {msg['filename']}", is_file=True)
-                    except json.JSONDecodeError:
-                        print("Error decoding message history")
-                
-                elif msg_type == "FILE_INFO":
-                    sender = parts[1]
-                    recipient = parts[2]
-                    file_name = parts[3]
-                    file_size = int(parts[4])
-                    timestamp = parts[5]
-                    
-                    # Initialize file data storage
-                    file_key = f"{sender}_{file_name}"
-                    file_data[file_key] = {
-                        "chunks": {},
-                        "total_chunks": 0,
-                        "received_chunks": 0,
-                        "sender": sender,
-                        "recipient": recipient,
-                        "timestamp": timestamp
-                    }
-                    
-                    # Create progress window for receiving
-                    if recipient == "Everyone" or recipient == self.username or sender == self.username:
-                        progress_window = tk.Toplevel(self.root)
-                        progress_window.title("Receiving File")
-                        progress_window.geometry("300x100")
-                        
-                        tk.Label(progress_window, text=f"Receiving {file_name} from {sender}...").pack(pady=(10, 5))
-                        progress = ttk.Progressbar(progress_window, length=250, mode="determinate")
-                        progress.pack(pady=5)
-                        
-                        file_data[file_key]["progress_window"] = progress_window
-                        file_data[file_key]["progress_bar"] = progress
+            except Exception as e:
+                print(f"Error receiving message: {str(e)}")
+                self.ui(self.status_label.config, text="Disconnected", fg="red")
+                break
+        
+        # Transfers cut off by the disconnect will never complete
+        for incoming in file_data.values():
+            self.discard_incoming_file(incoming)
+        # Downloads ask again for what has not arrived once reconnected
+        for download in list(self.downloads.values()):
+            download["requested"] = download["received_bytes"]
+        # Uploads offer the file again once reconnected and continue from
+        # what the server kept
+        for upload in list(self.uploads.values()):
+            upload.interrupt()
+        self.presence_seq = None
+        self.loading_older = None  # Will not be answered now; asked again once reconnected
+
+    def handle_server_message(self, msg, file_data):
+        """Handle one message received from the server"""
+        if isinstance(msg, BinaryMessage):
+            parts = msg.header.split("|")
+        else:
+            parts = msg.split("|")
+        msg_type = parts[0]
+        
+        if msg_type == "USERS_LIST":
+            self.ui(self.update_users_list, parts[1:])
+        
+        elif msg_type == "PRESENCE_SNAPSHOT":
+            # Format: PRESENCE_SNAPSHOT|seq|user1|user2|...
+            self.presence_seq = int(parts[1])
+            self.ui(self.update_users_list, [user for user in parts[2:] if user])
+        
+        elif msg_type in ("PRESENCE_JOIN", "PRESENCE_LEAVE"):
+            # Format: PRESENCE_JOIN|seq|username or PRESENCE_LEAVE|seq|username
+            seq = int(parts[1])
+            if self.presence_seq is None or seq <= self.presence_seq:
+                return  # Already covered by the snapshot (or one is on its way)
+            if seq != self.presence_seq + 1:
+                # Missed an update; ignore deltas until a fresh snapshot arrives
+                self.presence_seq = None
+                self.send_frame("PRESENCE_SYNC")
+                return
+            self.presence_seq = seq
+            if msg_type == "PRESENCE_JOIN":
+                self.ui(self.add_online_user, parts[2])
+            else:
+                self.ui(self.remove_online_user, parts[2])
+        
+        elif msg_type == "TYPING":
+            # The server sends everyone typing in a conversation at once:
+            # TYPING|user1, user2|recipient|are typing...
+            typists = [name for name in parts[1].split(", ") if name and name != self.username]
+            recipient = parts[2]
+            
+            if (recipient == "Everyone" or recipient == self.username or recipient == self.current_recipient
+                    or self.current_recipient in typists):
+                if typists:
+                    verb = "is typing..." if len(typists) == 1 else "are typing..."
+                    self.ui(self.typing_label.config, text=f"{', '.join(typists)} {verb}")
+                else:
+                    self.ui(self.typing_label.config, text="")
+        
+        elif msg_type == "COMPRESS":
+            # Format: COMPRESS|codec (empty: the server does not compress)
+            self.compressor = Compressor(parts[1]) if parts[1] else None
+        
+        elif msg_type == "SESSION_TOKEN":
+            # Format: SESSION_TOKEN|token
+            self.session_token = parts[1]
+        
+        elif msg_type == "MSG_ACK":
+            # Format: MSG_ACK|message_id
+            self.outbox.pop(parts[1], None)
+        
+        elif msg_type == "MSG":
+            sender = parts[1]
+            recipient = parts[2]
+            content = parts[3]
+            timestamp = parts[4]
+            message_id = parts[5] if len(parts) > 5 else None  # Older servers send none
+            
+            if recipient.startswith(ROOM_PREFIX):
+                self.display_message(f"[{recipient}] {sender} ({timestamp}): {content}", message_id=message_id)
+            else:
+                self.display_message(f"{sender} ({timestamp}): {content}", message_id=message_id)
+        
+        elif msg_type == "PRIVATE":
+            sender = parts[1]
+            recipient = parts[2]
+            content = parts[3]
+            timestamp = parts[4]
+            message_id = parts[5] if len(parts) > 5 else None
+            
+            if recipient == self.username:
+                self.display_message(f"[Private] {sender} ({timestamp}): {content}", message_id=message_id)
+        
+        elif msg_type == "HISTORY":
+            # Format: HISTORY|json_data; long histories come in several frames,
+            # each shown as soon as it arrives
+            self.display_history("|".join(parts[1:]))
+        
+        elif msg_type == "HISTORY_PAGE":
+            # Format: HISTORY_PAGE|before_id|json_data, in one or more frames;
+            # older messages for the top of chat_area
+            messages = self.parse_history("|".join(parts[2:]))
+            if messages is not None:
+                self.ui(self.prepend_chat, parts[1], messages)
+        
+        elif msg_type == "SEARCH_RESULTS":
+            # Format: SEARCH_RESULTS|json_data, in one or more frames; not part
+            # of the scrollback, so shown without message ids
+            self.display_history("|".join(parts[1:]), ids=False)
+        
+        elif msg_type == "ROOM_JOINED":
+            # Format: ROOM_JOINED|#room|member1|member2|...
+            room = parts[1]
+            if room in self.rejoining:
+                self.rejoining.discard(room)
+                return  # Back in a room we were in before reconnecting
+            if room not in self.joined_rooms:
+                self.joined_rooms.append(room)
+                self.ui(self.rooms_list.insert, tk.END, room)
+            self.ui(self.switch_to_room, room)
+            self.display_message(f"SERVER: In {room}: {', '.join(parts[2:])}")
+        
+        elif msg_type == "ROOM_HISTORY":
+            # Format: ROOM_HISTORY|#room|json_data, one frame per part of the history
+            self.display_history("|".join(parts[2:]))
+        
+        elif msg_type == "ROOM_LEFT":
+            # Format: ROOM_LEFT|#room
+            room = parts[1]
+            if room in self.joined_rooms:
+                self.ui(self.rooms_list.delete, self.joined_rooms.index(room))
+                self.joined_rooms.remove(room)
+            self.ui(self.left_room, room)
+        
+        elif msg_type == "FILE_INFO":
+            sender = parts[1]
+            recipient = parts[2]
+            file_name = parts[3]
+            file_size = int(parts[4])
+            timestamp = parts[5]
+            
+            # Chunks are written straight into a .part file as they arrive
+            import hashlib
+            import tempfile
+            file_key = f"{sender}_{file_name}"
+            if file_key in file_data:
+                self.discard_incoming_file(file_data.pop(file_key))
+            part = tempfile.NamedTemporaryFile(dir=received_dir(), suffix=".part", delete=False)
+            file_data[file_key] = {
+                "file": part,
+                "checksum": hashlib.sha256(),
+                "hashed_bytes": 0,  # Chunks arrive in order, so they are hashed as they are written
+                "received_bytes": 0,
+                "file_size": file_size,
+                "sender": sender,
+                "recipient": recipient,
+                "timestamp": timestamp
+            }
+            
+            # Create progress window for receiving
+            if recipient == "Everyone" or recipient == self.username or sender == self.username:
+                self.ui(self.open_receive_progress, file_data[file_key], file_name, sender)
+        
+        elif msg_type == "FILE_AVAILABLE":
+            # Format: FILE_AVAILABLE|sender|recipient|file_name|file_size|timestamp|sha256
+            self.start_download(parts[1], parts[3], int(parts[4]), parts[6])
+        
+        elif msg_type == "FILE_DATA":
+            # Format: FILE_DATA|sha256|offset (binary)
+            download = self.downloads.get(parts[1])
+            if download and isinstance(msg, BinaryMessage):
+                self.receive_download_data(parts[1], download, int(parts[2]), msg.data)
+        
+        elif msg_type == "FILE_RESUME":
+            # Format: FILE_RESUME|file_name|offset
+            upload = self.uploads.get(parts[1])
+            if upload:
+                upload.resume(int(parts[2]))
+        
+        elif msg_type == "FILE_FAILED":
+            # Format: FILE_FAILED|file_name or sha256|reason
+            upload = self.uploads.get(parts[1])
+            download = self.downloads.pop(parts[1], None)
+            if upload:
+                upload.fail(parts[2])
+            elif download:
+                self.close_download(download)
+                self.display_message(f"SERVER: Could not download {download['file_name']}: {parts[2]}")
+        
+        elif msg_type == "FILE_ACK":
+            # Format: FILE_ACK|file_name|chunk_num
+            upload = self.uploads.get(parts[1])
+            if upload:
+                upload.ack(int(parts[2]))
+        
+        elif msg_type == "FILE_CHUNK":
+            sender = parts[1]
+            recipient = parts[2]
+            file_name = parts[3]
+            
+            file_key = f"{sender}_{file_name}"
+            if file_key in file_data:
+                incoming = file_data[file_key]
+                if isinstance(msg, BinaryMessage):
+                    # Format: FILE_CHUNK|sender|recipient|file_name|chunk_num|total_chunks|offset
+                    chunk_data = msg.data
+                    offset = int(parts[6])
+                else:
+                    # Base64 text chunk from an older client, always in order
+                    import base64
+                    chunk_data = base64.b64decode(parts[6])
+                    offset = incoming["received_bytes"]
                 
-                elif msg_type == "FILE_CHUNK":
-                    sender = parts[1]
-                    recipient = parts[2]
-                    file_name = parts[3]
-                    chunk_num = int(parts[4])
-                    total_chunks = int(parts[5])
-                    chunk_data = parts[6]
-                    
-                    file_key = f"{sender}_{file_name}"
-                    if file_key in file_data:
-                        file_data[file_key]["chunks"][chunk_num] = chunk_data
-                        file_data[file_key]["total_chunks"] = total_chunks
-                        file_data[file_key]["received_chunks"] += 1
-                        
-                        # Update progress bar
-                        if "progress_bar" in file_data[file_key]:
-                            progress = file_data[file_key]["received_chunks"] / total_chunks * 100
-                            file_data[file_key]["progress_bar"]["value"] = progress
-                            file_data[file_key]["progress_window"].update()
+                incoming["file"].seek(offset)
+                incoming["file"].write(chunk_data)
+                if offset == incoming["hashed_bytes"]:
+                    incoming["checksum"].update(chunk_data)
+                    incoming["hashed_bytes"] += len(chunk_data)
+                incoming["received_bytes"] += len(chunk_data)
                 
-                elif msg_type == "FILE_COMPLETE":
-                    sender = parts[1]
-                    recipient = parts[2]
-                    file_name = parts[3]
-                    timestamp = parts[4]
-                    
-                    file_key = f"{sender}_{file_name}"
-                    if file_key in file_data:
-                        # Close progress window
-                        if "progress_window" in file_data[file_key]:
-                            file_data[file_key]["progress_window"].destroy()
-                        
-                        # Combine chunks
-                        chunks = file_data[file_key]["chunks"]
-                        total_chunks = file_data[file_key]["total_chunks"]
-                        combined_data = ""
-                        
-                        for i in range(total_chunks):
-                            if i in chunks:
-                                combined_data += chunks[i]
-                        
-                        # Store the file data for download
-                        file_data[file_key]["data"] = combined_data
-                        
-                        # Display message
-                        if recipient == "Everyone" or recipient == self.username or sender == self.username:
-                            self.display_message(
-                                f"{sender} sent a file: {file_name}", 
-                                is_file=True, 
-                                file_name=file_name, 
-                                file_data=combined_data
-                            )
+                self.ui(self.update_progress, incoming)
+        
+        elif msg_type == "FILE_COMPLETE":
+            sender = parts[1]
+            recipient = parts[2]
+            file_name = parts[3]
+            timestamp = parts[4]
+            expected_checksum = parts[5] if len(parts) > 5 else None  # Older clients send none
+            
+            file_key = f"{sender}_{file_name}"
+            if file_key in file_data:
+                incoming = file_data.pop(file_key)
                 
-                elif msg_type == "SERVER":
-                    self.display_message(f"SERVER: {parts[1]}")
+                self.ui(self.close_progress, incoming)
+                file_path = self.finish_incoming_file(incoming, file_name, expected_checksum)
+                if file_path is None:
+                    self.display_message(f"SERVER: {file_name} from {sender} was corrupted in transfer and has been discarded")
                 
+                # Display message
+                elif recipient == "Everyone" or recipient == self.username or sender == self.username:
+                    self.display_message(
+                        f"{sender} sent a file: {file_name}", 
+                        is_file=True, 
+                        file_name=file_name, 
+                        file_path=file_path
+                    )
+        
+        elif msg_type == "SERVER":
+            self.display_message(f"SERVER: {parts[1]}")
+        
+        else:
+            self.display_message(msg)
+
+    def parse_history(self, history_data):
+        """A JSON array of stored messages as a list, or None if it is garbled"""
+        import json
+        try:
+            return json.loads(history_data)
+        except json.JSONDecodeError:
+            print("Error decoding message history")
+            return None
+
+    def display_history(self, history_data, ids=True):
+        """Show a JSON array of stored messages, oldest first"""
+        messages = self.parse_history(history_data)
+        if messages is not None:
+            for line in self.history_lines(messages, ids):
+                self.ui_queue.put(line)
+
+    def history_lines(self, messages, ids=True):
+        """Chat lines for stored messages; with ids, each line keeps its message's _id"""
+        lines = []
+        for msg in messages:
+            message_id = msg.get("_id") if ids else None
+            if msg["type"] == "message":
+                if msg["recipient"] == "Everyone":
+                    text = f"{msg['sender']} ({msg['timestamp']}): {msg['content']}"
+                elif msg["recipient"].startswith(ROOM_PREFIX):
+                    text = f"[{msg['recipient']}] {msg['sender']} ({msg['timestamp']}): {msg['content']}"
+                elif msg["recipient"] == self.username or msg["sender"] == self.username:
+                    text = f"[Private] {msg['sender']} to {msg['recipient']} ({msg['timestamp']}): {msg['content']}"
                 else:
-                    self.display_message(msg)
-                    
-            except Exception as e:
-                print(f"Error receiving message: {str(e)}")
-                self.status_label.config(text="Disconnected", fg="red")
-                break
+                    continue
+                lines.append(self.chat_line(text, message_id=message_id))
+            elif msg["type"] == "file":
+                # Files in the server's store can be fetched again at any time
+                fetch = None
+                if "sha256" in msg:
+                    fetch = lambda m=msg: self.network(self.start_download, m["sender"], m["filename"],
+                                                       int(m["filesize"]), m["sha256"])
+                if msg["recipient"] == "Everyone" or msg["recipient"].startswith(ROOM_PREFIX):
+                    text = f"{msg['sender']} sent a file: {msg['filename']}"
+                elif msg["recipient"] == self.username or msg["sender"] == self.username:
+                    text = f"[Private] {msg['sender']} sent a file to {msg['recipient']}: {msg['filename']}"
+                else:
+                    continue
+                lines.append(self.chat_line(text, is_file=True, file_name=msg["filename"], fetch=fetch, message_id=message_id))
+        return lines
 
     def update_users_list(self, users):
         self.online_users = users
@@ -603,42 +1253,383 @@ class ChatClient:
             if user != self.username:  # Don't add ourselves to the list
                 self.users_list.insert(tk.END, user)
 
+    def add_online_user(self, user):
+        if user in self.online_users:
+            return
+        self.online_users.append(user)
+        if user != self.username:
+            self.users_list.insert(tk.END, user)
+
+    def remove_online_user(self, user):
+        if user not in self.online_users:
+            return
+        self.online_users.remove(user)
+        if user != self.username:
+            # Row 0 is "Everyone"; the rest follow online_users without ourselves
+            rows = self.users_list.get(1, tk.END)
+            if user in rows:
+                self.users_list.delete(rows.index(user) + 1)
+
     def search_messages(self, event=None):
         search_term = self.search_entry.get().strip()
         if search_term and search_term != "Search messages...":
-            self.client_socket.send(f"SEARCH|{search_term}".encode())
+            self.display_message(f"--- Search results for '{search_term}' ---")
+            if self.current_recipient.startswith(ROOM_PREFIX):
+                self.send_frame(f"SEARCH|{search_term}|{self.current_recipient}")  # Only this room
+            else:
+                self.send_frame(f"SEARCH|{search_term}")
+
+    def open_receive_progress(self, incoming, file_name, sender):
+        """Show a progress window for an incoming file"""
+        progress_window = tk.Toplevel(self.root)
+        progress_window.title("Receiving File")
+        progress_window.geometry("300x100")
+        
+        tk.Label(progress_window, text=f"Receiving {file_name} from {sender}...").pack(pady=(10, 5))
+        progress = ttk.Progressbar(progress_window, length=250, mode="determinate")
+        progress.pack(pady=5)
+        
+        incoming["progress_window"] = progress_window
+        incoming["progress_bar"] = progress
+
+    def update_progress(self, incoming):
+        """Show how much of an incoming file has arrived (Tk thread)"""
+        if "progress_bar" in incoming and incoming["file_size"]:
+            incoming["progress_bar"]["value"] = min(incoming["received_bytes"] / incoming["file_size"] * 100, 100)
+
+    def close_progress(self, incoming):
+        """Close the progress window of an incoming file, if it has one (Tk thread)"""
+        progress_window = incoming.pop("progress_window", None)
+        if progress_window is not None:
+            progress_window.destroy()
 
-    def display_message(self, message, is_file=False, file_name=None, file_data=None):
+    def start_download(self, sender, file_name, file_size, digest):
+        """Fetch a file from the server's store, resuming an earlier partial download (network thread)"""
+        if digest in self.downloads:
+            return
+        import hashlib
+        file_path = os.path.join(received_dir(), f"{digest[:16]}-{os.path.basename(file_name)}")
+        if os.path.exists(file_path):
+            # Downloaded before
+            self.display_message(f"{sender} sent a file: {file_name}", is_file=True, file_name=file_name, file_path=file_path)
+            return
+        
+        part_path = os.path.join(received_dir(), f"{digest}.part")
+        open(part_path, "ab").close()
+        part = open(part_path, "r+b")
+        resumed = part.seek(0, os.SEEK_END)
+        download = {
+            "file": part,
+            "checksum": hashlib.sha256(),
+            "hashed_bytes": 0,  # A resumed download is hashed from disk when it completes
+            "received_bytes": resumed,
+            "requested": resumed,  # Next offset to FILE_FETCH
+            "file_size": file_size,
+            "file_name": file_name,
+            "sender": sender
+        }
+        self.downloads[digest] = download
+        self.ui(self.open_receive_progress, download, file_name, sender)
+        if resumed >= file_size:
+            self.receive_download_data(digest, download, resumed, b"")
+            return
+        self.request_download_data(digest, download)
+
+    def request_download_data(self, digest, download):
+        """Keep two FILE_FETCH windows outstanding"""
+        while (download["requested"] < download["file_size"]
+               and download["requested"] - download["received_bytes"] < 2 * FILE_DOWNLOAD_WINDOW):
+            self.send_frame(f"FILE_FETCH|{digest}|{download['requested']}|{FILE_DOWNLOAD_WINDOW}")
+            download["requested"] += FILE_DOWNLOAD_WINDOW
+
+    def receive_download_data(self, digest, download, offset, data):
+        """Write FILE_DATA at its offset; finish the download once every byte is there"""
+        if data:
+            download["file"].seek(offset)
+            download["file"].write(data)
+            if offset == download["hashed_bytes"]:
+                download["checksum"].update(data)
+                download["hashed_bytes"] += len(data)
+            download["received_bytes"] += len(data)
+        
+        if download["received_bytes"] < download["file_size"]:
+            self.ui(self.update_progress, download)
+            self.request_download_data(digest, download)
+            return
+        
+        del self.downloads[digest]
+        self.ui(self.close_progress, download)
+        file_path = self.finish_incoming_file(download, download["file_name"], digest)
+        if file_path is None:
+            self.display_message(f"SERVER: {download['file_name']} from {download['sender']} was corrupted in transfer and has been discarded")
+        else:
+            self.display_message(
+                f"{download['sender']} sent a file: {download['file_name']}",
+                is_file=True,
+                file_name=download["file_name"],
+                file_path=file_path
+            )
+
+    def close_download(self, download):
+        """Stop a download, keeping its .part file so it can resume later"""
+        download["file"].close()
+        self.ui(self.close_progress, download)
+
+    def finish_incoming_file(self, incoming, file_name, expected_checksum):
+        """Verify a received .part file and rename it; returns its path, or None if corrupt"""
+        part = incoming["file"]
+        if incoming["hashed_bytes"] != incoming["received_bytes"]:
+            # Some chunk arrived out of order; hash the file from disk instead
+            import hashlib
+            checksum = hashlib.sha256()
+            part.seek(0)
+            for block in iter(lambda: part.read(1024 * 1024), b""):
+                checksum.update(block)
+        else:
+            checksum = incoming["checksum"]
+        part.close()
+        
+        digest = checksum.hexdigest()
+        if expected_checksum and digest != expected_checksum:
+            os.remove(part.name)
+            return None
+        
+        file_path = os.path.join(received_dir(), f"{digest[:16]}-{os.path.basename(file_name)}")
+        try:
+            os.replace(part.name, file_path)
+        except FileNotFoundError:
+            # Another session on this machine finished the same download first
+            if not os.path.exists(file_path):
+                raise
+        return file_path
+
+    def discard_incoming_file(self, incoming):
+        """Drop an unfinished transfer and its .part file"""
+        incoming["file"].close()
+        try:
+            os.remove(incoming["file"].name)
+        except OSError:
+            pass
+        self.ui(self.close_progress, incoming)
+
+    def network(self, func, *args):
+        """Run func on the network thread, which owns the download state (safe from any thread)"""
+        self.network_queue.put(functools.partial(func, *args))
+        try:
+            self.network_waker.send(b"\0")
+        except OSError:
+            pass  # Wake-ups already queued are enough
+
+    def run_network_tasks(self):
+        """Run the work other threads queued with network() (network thread)"""
+        try:
+            self.network_wake.recv(4096)
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                task = self.network_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                task()
+            except Exception as e:
+                print(f"Error in network task: {str(e)}")
+
+    def ui(self, func, *args, **kwargs):
+        """Run func on the Tk thread at the next UI tick (safe from any thread)"""
+        self.ui_queue.put(functools.partial(func, *args, **kwargs))
+
+    def process_ui_queue(self):
+        """Apply the UI updates queued since the last tick (Tk thread)"""
+        lines = []  # [(text, button, message id)] chat lines to insert together
+        try:
+            for _ in range(UI_BATCH_MAX):
+                item = self.ui_queue.get_nowait()
+                if isinstance(item, tuple):
+                    lines.append(item)
+                    continue
+                if lines:
+                    # Keep chat lines in order with the updates around them
+                    self.apply_ui(self.write_chat, lines)
+                    lines = []
+                self.apply_ui(item)
+        except queue.Empty:
+            pass
+        finally:
+            if lines:
+                self.apply_ui(self.write_chat, lines)
+            self.apply_ui(self.check_scrollback)
+            # Come back right away if the queue is still not empty; always
+            # come back, or no update would ever reach the window again
+            self.root.after(1 if not self.ui_queue.empty() else UI_TICK_MS, self.process_ui_queue)
+
+    def apply_ui(self, func, *args):
+        """Run one UI update, logging instead of raising if it fails (Tk thread)"""
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"Error updating the window: {str(e)}")
+
+    def write_chat(self, lines):
+        """Append chat lines to chat_area in as few inserts as possible and scroll once (Tk thread)"""
+        if self.browsing:
+            self.held.extend(lines)
+            return
+        at_bottom = self.chat_area.yview()[1] >= 1.0  # Otherwise the user is reading older lines
         self.chat_area.config(state=tk.NORMAL)
+        entries = self.insert_chat("end-1c", lines)
+        self.chat_items.extend(entries)
+        if self.oldest_id is None:
+            self.oldest_id = next((message_id for _, message_id in entries if message_id), None)
+        if self.chat_lines > self.max_lines:
+            self.trim_chat(oldest=True)
+        self.chat_area.config(state=tk.DISABLED)
+        if at_bottom:
+            self.chat_area.yview(tk.END)
+
+    def insert_chat(self, index, lines):
+        """Insert chat lines at index; returns a [line count, message id] entry per line (Tk thread)"""
+        self.chat_area.mark_set("chat_insert", index)  # Moves along with what is inserted
+        entries = []
+        text = []
+        for line, button, message_id in lines:
+            text.append(line + "\n")
+            count = line.count("\n") + 1
+            if button is not None:
+                # Buttons need their own window_create; insert the text before them first
+                self.chat_area.insert("chat_insert", "".join(text))
+                text = []
+                label, command = button
+                btn = tk.Button(
+                    self.chat_area, text=label,
+                    command=command, fg="blue", cursor="hand2",
+                    bg=self.current_theme["bg"]
+                )
+                self.chat_area.window_create("chat_insert", window=btn)
+                self.chat_area.insert("chat_insert", "\n")
+                count += 1
+            entries.append([count, message_id])
+            self.chat_lines += count
+        if text:
+            self.chat_area.insert("chat_insert", "".join(text))
+        return entries
+
+    def trim_chat(self, oldest):
+        """Bring chat_area back under max_lines, dropping whole entries from the top
+        (oldest) or from the bottom, at least CHAT_EVICT_LINES at a time (Tk thread)"""
+        keep = self.max_lines - min(CHAT_EVICT_LINES, self.max_lines // 2)
+        removed = 0
+        evicted_id = None  # Newest message id dropped from the top
+        while self.chat_lines - removed > keep and self.chat_items:
+            count, message_id = self.chat_items.popleft() if oldest else self.chat_items.pop()
+            removed += count
+            evicted_id = message_id or evicted_id
+        if oldest:
+            self.delete_chat("1.0", f"{removed + 1}.0")
+            # Scrolling back up fetches what was dropped
+            self.oldest_id = next((message_id for _, message_id in self.chat_items if message_id), evicted_id)
+            self.more_history = True
+            self.page = None  # Its lines may be gone; the rest of it is not wanted any more
+        else:
+            self.delete_chat(f"{self.chat_lines - removed + 1}.0", "end-1c")
+            self.browsing = True
+        self.chat_lines -= removed
+
+    def delete_chat(self, start, end):
+        """Delete part of chat_area along with the buttons in it (Tk thread)"""
+        for name in self.chat_area.window_names():
+            name = str(name)
+            if self.chat_area.compare(name, ">=", start) and self.chat_area.compare(name, "<", end):
+                self.chat_area.nametowidget(name).destroy()
+        self.chat_area.delete(start, end)
+
+    def check_scrollback(self):
+        """Fetch older messages when the view reaches the top of chat_area, and
+        return to the live chat when it reaches the bottom (Tk thread)"""
+        first, last = self.chat_area.yview()
+        if self.browsing and last >= 1.0:
+            self.resume_live()
+        elif first <= 0.0 and self.more_history and self.oldest_id and self.loading_older is None:
+            self.loading_older = self.oldest_id
+            if not self.send_frame(f"HISTORY_REQUEST|{self.oldest_id}"):
+                self.loading_older = None
+
+    def prepend_chat(self, before_id, messages):
+        """Put a frame of a HISTORY_PAGE above the lines shown (Tk thread)"""
+        if self.page is None or self.page[0] != before_id:
+            # First frame of a page; later frames go below it
+            if before_id != self.loading_older:
+                return  # Asked for before chat_area was reset
+            self.loading_older = None
+            if not messages:
+                self.more_history = False
+                return
+            self.oldest_id = messages[0]["_id"]
+            self.page = [before_id, 0, 0]
         
+        top = int(self.chat_area.index("@0,0").split(".")[0])  # First line on screen
+        self.chat_area.config(state=tk.NORMAL)
+        entries = self.insert_chat(f"{self.page[1] + 1}.0", self.history_lines(messages))
+        for i, entry in enumerate(entries):
+            self.chat_items.insert(self.page[2] + i, entry)
+        added = sum(count for count, _ in entries)
+        self.page[1] += added
+        self.page[2] += len(entries)
+        if self.chat_lines > self.max_lines:
+            self.trim_chat(oldest=False)
+        self.chat_area.config(state=tk.DISABLED)
+        # Keep the lines that were on screen where they were
+        self.chat_area.yview(f"{top + added}.0")
+
+    def resume_live(self):
+        """Scrolled down to the bottom while browsing: show the latest lines again (Tk thread)"""
+        self.browsing = False
+        self.chat_area.config(state=tk.NORMAL)
+        self.delete_chat("1.0", "end-1c")
+        self.chat_area.config(state=tk.DISABLED)
+        self.chat_items.clear()
+        self.chat_lines = 0
+        self.oldest_id = None
+        self.more_history = True
+        self.loading_older = None
+        self.page = None
+        held = list(self.held)
+        self.held.clear()
+        self.write_chat(held)
+        if self.oldest_id is None:
+            self.send_frame("HISTORY_REQUEST")  # Nothing to page back from; start from the latest
+
+    def chat_line(self, message, is_file=False, file_name=None, file_path=None, fetch=None, message_id=None):
+        """A (text, button, message id) line for write_chat"""
         # Add timestamp if not already in message
         if " (" not in message and not message.startswith("SERVER:") and not message.startswith("---"):
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             message = f"{message} ({timestamp})"
         
-        self.chat_area.insert(tk.END, message + "\n")
-
-        if is_file and file_name:
+        button = None
+        if is_file and file_name and file_path:
             def save_file():
                 save_path = filedialog.asksaveasfilename(defaultextension="", initialfile=file_name)
                 if save_path:
+                    import shutil
                     try:
-                        with open(save_path, "wb") as f:
-                            f.write(base64.b64decode(file_data))
+                        shutil.copyfile(file_path, save_path)
                         messagebox.showinfo("Download", f"File saved as {save_path}")
                     except Exception as e:
                         messagebox.showerror("Error", f"Failed to save file: {str(e)}")
 
-            btn = tk.Button(
-                self.chat_area, text=f"Download {file_name}", 
-                command=save_file, fg="blue", cursor="hand2",
-                bg=self.current_theme["bg"]
-            )
-            self.chat_area.window_create(tk.END, window=btn)
-            self.chat_area.insert(tk.END, "\n")
+            button = (f"Download {file_name}", save_file)
+        
+        elif is_file and file_name and fetch:
+            # Not downloaded yet: fetch it from the server's file store
+            button = (f"Fetch {file_name}", fetch)
+        
+        return (message, button, message_id)
 
-        self.chat_area.config(state=tk.DISABLED)
-        self.chat_area.yview(tk.END)
+    def display_message(self, message, is_file=False, file_name=None, file_path=None, fetch=None, message_id=None):
+        """Queue a line for chat_area (safe from any thread)"""
+        self.ui_queue.put(self.chat_line(message, is_file, file_name, file_path, fetch, message_id))
 
     def show_emoji_picker(self):
         picker = tk.Toplevel(self.root)
@@ -669,15 +1660,24 @@ class ChatClient:
         self.msg_entry.insert(tk.END, emoji)
 
     def on_close(self):
+        self.closing = True
         try:
-            self.client_socket.send(f"LOGOUT|{self.username}".encode())
+            self.send_frame(f"LOGOUT|{self.username}")
             self.client_socket.close()
         except:
             pass
         self.root.quit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CryptoChat client")
+    parser.add_argument("--scrollback", type=int, default=CHAT_MAX_LINES,
+                        help=f"Lines kept in the chat window (default {CHAT_MAX_LINES})")
+    parser.add_argument("--startup-benchmark", action="store_true",
+                        help="Print how long the login window and the connection take to appear, then exit")
+    args = parser.parse_args()
+    
     root = tk.Tk()
     root.geometry("800x600")
-    app = ChatClient(root)
-    root.mainloop()
+    app = ChatClient(root, max_lines=max(args.scrollback, 100), startup_benchmark=args.startup_benchmark)
+    if not args.startup_benchmark:
+        root.mainloop()
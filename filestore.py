@@ -0,0 +1,195 @@
+# CONTENT-ADDRESSED FILE STORE
+#
+# Uploaded files are kept once on local disk, named by their SHA-256:
+#
+#   <root>/ab/abcdef...      complete files, fanned out by the first two hex digits
+#   <root>/partial/abcdef... uploads in progress
+#
+# A partial upload survives disconnects, so a sender who offers the same file
+# again continues from the bytes already stored, and a file that is already
+# complete is never uploaded twice. Recipients read from the store at their
+# own pace instead of having chunks pushed to them as they arrive.
+#
+# Partial uploads count against their uploader's quota until they complete,
+# and expire() deletes the ones nobody has written to for a while.
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+SHARE_LOG_CAPACITY = 10000  # Recent file records kept in memory for access checks
+
+_DIGEST = re.compile(r"[0-9a-f]{64}")
+
+class StoreError(Exception):
+    """Raised when an upload cannot be accepted"""
+
+class _Upload:
+    __slots__ = ("owner", "size", "file", "checksum")
+
+    def __init__(self, owner, size, file, checksum):
+        self.owner = owner
+        self.size = size
+        self.file = file
+        self.checksum = checksum
+
+class FileStore:
+    def __init__(self, root, max_file_size, partial_quota, partial_ttl):
+        self.root = root
+        self.max_file_size = max_file_size
+        self.partial_quota = partial_quota  # Bytes of unfinished uploads one user may hold
+        self.partial_ttl = partial_ttl  # Seconds an untouched partial file is kept
+        self._lock = threading.Lock()
+        self._uploads = {}  # {digest: _Upload} for uploads with an open partial file
+        self._partials = {}  # {digest: [username, size, last write]} for every partial file
+        partial_dir = os.path.join(root, "partial")
+        os.makedirs(partial_dir, exist_ok=True)
+        # Left over from before a restart: nobody's quota, expire as usual
+        for entry in os.scandir(partial_dir):
+            if _DIGEST.fullmatch(entry.name):
+                stat = entry.stat()
+                self._partials[entry.name] = [None, stat.st_size, stat.st_mtime]
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def size(self, digest):
+        """Size of a complete file, or None if the store does not have it"""
+        if not _DIGEST.fullmatch(digest):
+            return None
+        try:
+            return os.path.getsize(self.path(digest))
+        except OSError:
+            return None
+
+    def offer(self, digest, size, owner, username, reupload=False):
+        """Start or resume an upload; returns how many bytes are already stored.
+
+        A returned offset equal to size means the store already has the file.
+        reupload=True makes the uploader send a stored file anyway, to show
+        they have it. The latest offer for a digest owns the upload, so a
+        client that reconnects takes over from its own dead connection.
+        """
+        if not _DIGEST.fullmatch(digest):
+            raise StoreError("invalid checksum")
+        if not 0 <= size <= self.max_file_size:
+            raise StoreError("file too large")
+        if not reupload and self.size(digest) == size:
+            return size
+        with self._lock:
+            upload = self._uploads.get(digest)
+            if upload is not None and upload.size != size:
+                raise StoreError("size does not match the upload in progress")
+            held = sum(entry[1] for key, entry in self._partials.items()
+                       if entry[0] == username and key != digest)
+            if held + size > self.partial_quota:
+                raise StoreError("too many unfinished uploads")
+            self._partials[digest] = [username, size, time.time()]
+            if upload is None:
+                partial = os.path.join(self.root, "partial", digest)
+                file = open(partial, "a+b")
+                if file.seek(0, os.SEEK_END) > size:
+                    file.truncate(0)  # Not from this file after all; start over
+                # Hash what an earlier attempt stored, so the final check covers it
+                checksum = hashlib.sha256()
+                file.seek(0)
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    checksum.update(block)
+                upload = self._uploads[digest] = _Upload(owner, size, file, checksum)
+            upload.owner = owner
+            offset = upload.file.tell()
+            if offset == size:
+                self._finish(digest, upload)  # Empty file, or every byte arrived before a disconnect
+            return offset
+
+    def write(self, digest, owner, offset, data):
+        """Append a chunk; returns True once the file is complete and verified"""
+        with self._lock:
+            upload = self._uploads.get(digest)
+            if upload is None or upload.owner is not owner:
+                raise StoreError("no upload in progress")
+            if offset != upload.file.tell():
+                raise StoreError(f"expected offset {upload.file.tell()}, got {offset}")
+            if offset + len(data) > upload.size:
+                raise StoreError("chunk past end of file")
+            upload.file.write(data)
+            upload.checksum.update(data)
+            self._partials[digest][2] = time.time()
+            metrics.incr("file_store_bytes_written", len(data))
+            if upload.file.tell() < upload.size:
+                return False
+            self._finish(digest, upload)
+            return True
+
+    def _finish(self, digest, upload):
+        """Verify a fully written upload and move it into place (lock held)"""
+        del self._uploads[digest]
+        self._partials.pop(digest, None)
+        upload.file.close()
+        partial = upload.file.name
+        if upload.checksum.hexdigest() != digest:
+            os.remove(partial)
+            raise StoreError("checksum mismatch")
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        os.replace(partial, self.path(digest))
+
+    def abandon(self, owner):
+        """Close the partial files of a disconnected uploader; the bytes stay for a resume"""
+        with self._lock:
+            for digest, upload in list(self._uploads.items()):
+                if upload.owner is owner:
+                    upload.file.close()
+                    del self._uploads[digest]
+
+    def expire(self):
+        """Delete partial files nobody has written to for partial_ttl seconds; returns how many"""
+        cutoff = time.time() - self.partial_ttl
+        removed = 0
+        with self._lock:
+            for digest, (_, _, touched) in list(self._partials.items()):
+                if touched < cutoff and digest not in self._uploads:
+                    try:
+                        os.remove(os.path.join(self.root, "partial", digest))
+                    except FileNotFoundError:
+                        pass
+                    del self._partials[digest]
+                    removed += 1
+        metrics.incr("file_store_partials_expired", removed)
+        return removed
+
+    def read(self, digest, offset, length):
+        """Read part of a complete file"""
+        with open(self.path(digest), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+class ShareLog:
+    """Who shared each stored file with whom, for the latest file records.
+
+    Access checks look here before MongoDB, which may not have written a
+    record yet when its recipients start fetching the file.
+    """
+
+    def __init__(self, capacity=SHARE_LOG_CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._shares = OrderedDict()  # {digest: [(sender, recipient), ...]}, least recently shared first
+
+    def add(self, document):
+        """Remember a file record (type "file" with a sha256)"""
+        with self._lock:
+            shares = self._shares.setdefault(document["sha256"], [])
+            shares.append((document["sender"], document["recipient"]))
+            del shares[:-100]  # A file shared over and over only needs its latest shares
+            self._shares.move_to_end(document["sha256"])
+            if len(self._shares) > self.capacity:
+                self._shares.popitem(last=False)
+
+    def shares(self, digest):
+        """(sender, recipient) pairs that shared digest recently"""
+        with self._lock:
+            return list(self._shares.get(digest, ()))
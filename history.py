@@ -0,0 +1,186 @@
+# RECENT-HISTORY CACHE
+#
+# Every login sends HISTORY_REQUEST. Instead of querying MongoDB each time,
+# the server keeps the most recent messages in memory:
+#
+#   public   one ring of the last HISTORY_LIMIT messages sent to "Everyone"
+#   private  one ring per user with their last HISTORY_LIMIT private messages
+#   rooms    one ring per room with its last HISTORY_LIMIT messages
+#
+# Each record holds the message already serialized as JSON, and the public
+# part of the reply is built once and shared by every requester until the
+# next public message arrives. A private ring starts out incomplete and is
+# filled from the database the first time its user asks for history; room
+# rings work the same way and share the same LRU.
+#
+# Messages go out with only the fields clients display (HISTORY_FIELDS), and
+# replies are split into JSON arrays of about HISTORY_FRAME_BYTES, one per
+# frame, so a client can show the first part while the rest is on its way.
+import heapq
+import json
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # The standard library encoder gives the same JSON, more slowly
+
+HISTORY_LIMIT = 50
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"  # How stored datetimes appear on the wire
+HISTORY_FRAME_BYTES = 64 * 1024  # JSON per HISTORY/SEARCH_RESULTS frame, roughly
+HISTORY_FIELDS = ("_id", "type", "sender", "recipient", "content", "timestamp", "filename", "filesize", "sha256")
+HISTORY_PROJECTION = dict.fromkeys(HISTORY_FIELDS, 1)  # MongoDB projection fetching only those
+
+def json_default(value):
+    """json.dumps hook for the BSON values stored in messages"""
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    return str(value)  # ObjectId
+
+def to_json(document):
+    """Serialize a stored message with only the fields clients display"""
+    lean = {field: document[field] for field in HISTORY_FIELDS if field in document}
+    if orjson is not None:
+        return orjson.dumps(lean, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+    return json.dumps(lean, default=json_default)
+
+def json_arrays(items, max_bytes=HISTORY_FRAME_BYTES):
+    """Group serialized messages into JSON arrays of about max_bytes each.
+
+    items is consumed lazily, so a cursor is serialized as it is sent. At
+    least one array is produced, empty if there were no items.
+    """
+    batch = []
+    size = 0
+    for item in items:
+        if batch and size + len(item) > max_bytes:
+            yield "[" + ",".join(batch) + "]"
+            batch = []
+            size = 0
+        batch.append(item)
+        size += len(item) + 1
+    if batch or not size:
+        yield "[" + ",".join(batch) + "]"
+
+class HistoryRecord:
+    __slots__ = ("id", "json")
+
+    def __init__(self, document):
+        self.id = document["_id"]
+        self.json = to_json(document)
+
+    def __lt__(self, other):
+        return self.id < other.id
+
+class PrivateRing:
+    __slots__ = ("records", "ids", "complete")
+
+    def __init__(self, size):
+        self.records = deque(maxlen=size)
+        self.ids = set()
+        self.complete = False
+
+    def add(self, record):
+        if record.id in self.ids:
+            return
+        if len(self.records) == self.records.maxlen:
+            self.ids.discard(self.records[0].id)
+        self.records.append(record)
+        self.ids.add(record.id)
+
+class HistoryCache:
+    def __init__(self, limit=HISTORY_LIMIT, max_users=10000, wrap=lambda text: text):
+        self.limit = limit
+        self.max_users = max_users  # Private rings kept before the least recently used is evicted
+        self.wrap = wrap  # Turns each JSON array into the object handed to callers
+        self._lock = threading.Lock()
+        self._public = deque(maxlen=limit)
+        self._private = OrderedDict()  # {username or room: PrivateRing}, least recently used first
+        self._public_payload = None  # Wrapped arrays of the public ring, built on demand
+
+    def load_public(self, documents):
+        """Seed the public ring from the database (oldest first)"""
+        with self._lock:
+            for document in documents:
+                self._public.append(HistoryRecord(document))
+            self._public_payload = None
+
+    def add(self, document):
+        """Record a message that was just sent; needs its _id already set"""
+        record = HistoryRecord(document)
+        with self._lock:
+            if document["recipient"] == "Everyone":
+                self._public.append(record)
+                self._public_payload = None
+                return
+            if "room" in document:
+                self._ring(document["room"]).add(record)
+                return
+            for username in {document["sender"], document["recipient"]}:
+                self._ring(username).add(record)
+
+    def history(self, username, load_private):
+        """Recent history visible to username, oldest first, as a list of wrapped arrays.
+
+        load_private(username, limit) is called (outside the lock) the first
+        time a user asks, and must return that user's latest private messages
+        from the database.
+        """
+        self._fill(username, load_private)
+        with self._lock:
+            ring = self._private.get(username)
+            if ring is not None:
+                self._private.move_to_end(username)
+            if ring is None or not ring.records:
+                if self._public_payload is None:
+                    self._public_payload = self._wrap_all(self._public)
+                return self._public_payload
+            records = list(heapq.merge(self._public, ring.records))[-self.limit:]
+        return self._wrap_all(records)
+
+    def room(self, room, load_room):
+        """JSON arrays of a room's recent messages, oldest first.
+
+        load_room(room, limit) is called the first time anyone asks, like
+        load_private in history().
+        """
+        self._fill(room, load_room)
+        with self._lock:
+            ring = self._private.get(room)
+            records = list(ring.records) if ring is not None else []
+        return list(json_arrays(record.json for record in records))
+
+    def _fill(self, key, load):
+        """Load a private or room ring from the database if it is not complete yet"""
+        with self._lock:
+            ring = self._private.get(key)
+            if ring is not None and ring.complete:
+                return
+        documents = load(key, self.limit)
+        with self._lock:
+            ring = self._ring(key)
+            if not ring.complete:
+                # Messages that arrived during the query are already in the
+                # ring; merge the older ones in front of them
+                merged = [HistoryRecord(d) for d in documents if d["_id"] not in ring.ids]
+                merged = sorted(merged + list(ring.records))[-self.limit:]
+                ring.records.clear()
+                ring.ids.clear()
+                for record in merged:
+                    ring.add(record)
+                ring.complete = True
+
+    def _ring(self, username):
+        ring = self._private.get(username)
+        if ring is None:
+            ring = self._private[username] = PrivateRing(self.limit)
+            if len(self._private) > self.max_users:
+                self._private.popitem(last=False)
+        else:
+            self._private.move_to_end(username)
+        return ring
+
+    def _wrap_all(self, records):
+        return [self.wrap(array) for array in json_arrays(record.json for record in records)]
@@ -0,0 +1,60 @@
+# LOGIN WAITER
+#
+# Threaded engine only. A connection that has finished its TLS handshake but
+# not sent its login yet (e.g. a client that connects while its user is
+# still typing a password) waits here instead of in an auth worker. One
+# thread watches all of them with a selector and hands each connection back
+# once it has something to read, or gives up on it at its deadline.
+import selectors
+import socket
+import threading
+import time
+
+class LoginWaiter:
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._waiting = {}  # {sock: (deadline, on_ready, on_expired)}, deadline on perf_counter()
+        # Parking a socket wakes the selector, so a nearer deadline is noticed
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._selector.register(self._wake_recv, selectors.EVENT_READ)
+
+    def park(self, sock, deadline, on_ready, on_expired):
+        """Call on_ready() once sock is readable, or on_expired() at deadline (once, from run's thread)"""
+        with self._lock:
+            self._waiting[sock] = (deadline, on_ready, on_expired)
+            self._selector.register(sock, selectors.EVENT_READ)
+        self._wake_send.send(b"\0")
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def run(self):
+        """Watch the parked sockets, forever (run in a thread)"""
+        while True:
+            with self._lock:
+                deadline = min((d for d, _, _ in self._waiting.values()), default=None)
+            timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            events = self._selector.select(timeout)
+            now = time.perf_counter()
+            done = []
+            with self._lock:
+                for key, _ in events:
+                    if key.fileobj is self._wake_recv:
+                        self._wake_recv.recv(4096)
+                    elif key.fileobj in self._waiting:
+                        done.append(self._release(key.fileobj)[1])
+                for sock, (deadline, _, _) in list(self._waiting.items()):
+                    if deadline <= now:
+                        done.append(self._release(sock)[2])
+            for callback in done:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"[ERROR] Login waiter: {str(e)}")
+
+    def _release(self, sock):
+        """Stop watching sock; returns its (deadline, on_ready, on_expired) (lock held)"""
+        self._selector.unregister(sock)
+        return self._waiting.pop(sock)
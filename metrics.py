@@ -0,0 +1,89 @@
+# SERVER METRICS
+#
+# A tiny thread-safe registry of counters, gauges and timings. Subsystems
+# import the shared `metrics` instance and record into it; the server prints
+# a summary line every few seconds (see report_metrics in server.py).
+import threading
+import time
+
+class Timing:
+    """Running count/total/max of an observed duration, in seconds"""
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self):
+        avg = self.total / self.count if self.count else 0.0
+        return {"count": self.count, "avg_ms": round(avg * 1000, 2), "max_ms": round(self.max * 1000, 2)}
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def add_gauge(self, name, amount):
+        with self._lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.observe(seconds)
+
+    def timer(self, name):
+        """Context manager that records how long its block took"""
+        return _Timer(self, name)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": {name: t.summary() for name, t in self.timings.items()},
+            }
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+metrics = Metrics()
+
+def format_snapshot(snapshot):
+    """Render a snapshot as one compact log line"""
+    parts = [f"{k}={v}" for k, v in sorted(snapshot["counters"].items())]
+    parts += [f"{k}={v}" for k, v in sorted(snapshot["gauges"].items())]
+    for name, t in sorted(snapshot["timings"].items()):
+        parts.append(f"{name}={t['avg_ms']}ms avg/{t['max_ms']}ms max (n={t['count']})")
+    return " ".join(parts)
@@ -0,0 +1,181 @@
+# WRITE-BEHIND MESSAGE PERSISTENCE
+#
+# Chat messages are queued here instead of being inserted on the sender's
+# thread. A background thread flushes the queue with insert_many whenever
+# PERSIST_BATCH_SIZE documents are waiting or PERSIST_FLUSH_INTERVAL has
+# passed, so delivery never waits for a MongoDB round trip.
+#
+# Durability modes:
+#   async    fire-and-forget; write() returns as soon as the document is queued
+#   batched  write() waits until the batch holding the document is stored
+#   sync     insert_one on the caller's thread (the original behaviour)
+#
+# Clients tag chat messages with their own message id and resend the ones
+# not yet acknowledged after a reconnect. RecentIds remembers the latest ids
+# so a resend is acknowledged without being delivered or stored again; a
+# unique index on (sender, client_id) catches whatever slips past it (e.g. a
+# resend reaching another node before that node heard of the original).
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from metrics import metrics
+
+PERSIST_MODES = ("async", "batched", "sync")
+DEDUP_CAPACITY = 100000  # Client message ids remembered for deduplication
+DUPLICATE_KEY = 11000  # MongoDB error code for a unique index violation
+
+_STOP = object()
+
+class MessageWriter:
+    def __init__(self, collection, mode="async", batch_size=500, flush_interval=0.05, max_queue=50000):
+        if mode not in PERSIST_MODES:
+            raise ValueError(f"unknown persistence mode {mode!r}")
+        self.collection = collection
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        if mode != "sync":
+            self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+            self._thread.start()
+
+    @property
+    def blocking(self):
+        """True if write() may wait for the database.
+
+        In async mode that only happens once the queue is full; the asyncio
+        engine then runs writes in its executor. Checking a little before
+        it is full covers writes racing in from other threads.
+        """
+        return self.mode != "async" or self._queue.qsize() >= self._queue.maxsize * 0.9
+
+    def write(self, document):
+        """Persist one document according to the durability mode.
+
+        The document gets its _id here, so callers can refer to the message
+        before it reaches the database.
+        """
+        document.setdefault("_id", ObjectId())
+        if self.mode == "sync":
+            try:
+                with metrics.timer("persist_flush"):
+                    self.collection.insert_one(document)
+            except DuplicateKeyError:
+                metrics.incr("persist_duplicates")  # A resent message, already stored
+                return
+            metrics.incr("persisted")
+            return
+
+        future = Future() if self.mode == "batched" else None
+        try:
+            self._queue.put_nowait((document, future))
+        except queue.Full:
+            # The database is falling behind; make the sender wait for room
+            metrics.incr("persist_queue_full")
+            self._queue.put((document, future))
+        if future is not None:
+            future.result()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self):
+        """Flush everything still queued and stop the writer thread"""
+        if self._thread is not None:
+            self._queue.put((_STOP, None))
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            stop = item[0] is _STOP
+            if not stop:
+                batch.append(item)
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item[0] is _STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+            if batch:
+                self._flush(batch)
+            if stop:
+                # Drain whatever was queued behind the stop marker
+                rest = []
+                while True:
+                    try:
+                        rest.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                rest = [item for item in rest if item[0] is not _STOP]
+                for start in range(0, len(rest), self.batch_size):
+                    self._flush(rest[start:start + self.batch_size])
+                return
+
+    def _flush(self, batch):
+        documents = [document for document, _ in batch]
+        error = None
+        try:
+            with metrics.timer("persist_flush"):
+                self.collection.insert_many(documents, ordered=False)
+            metrics.incr("persisted", len(documents))
+        except BulkWriteError as e:
+            # ordered=False: everything but the failed documents was inserted
+            failed = e.details.get("writeErrors", [])
+            duplicates = sum(1 for failure in failed if failure.get("code") == DUPLICATE_KEY)
+            metrics.incr("persisted", len(documents) - len(failed))
+            metrics.incr("persist_duplicates", duplicates)
+            if duplicates < len(failed):
+                error = e
+                metrics.incr("persist_errors")
+                print(f"[ERROR] Persisting {len(failed) - duplicates} of {len(documents)} messages: {str(e)}")
+        except Exception as e:
+            error = e
+            metrics.incr("persist_errors")
+            print(f"[ERROR] Persisting {len(documents)} messages: {str(e)}")
+        for _, future in batch:
+            if future is not None:
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+class RecentIds:
+    """The latest (sender, client message id) pairs, oldest forgotten first"""
+
+    def __init__(self, capacity=DEDUP_CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._ids = OrderedDict()  # {(sender, client_id): None}, an insertion-ordered set
+
+    def add(self, sender, client_id):
+        """Remember a message id; returns False if it was seen before"""
+        key = (sender, client_id)
+        with self._lock:
+            if key in self._ids:
+                return False
+            self._ids[key] = None
+            if len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+            return True
+
+    def discard(self, sender, client_id):
+        """Forget a message id again, e.g. when storing the message failed"""
+        with self._lock:
+            self._ids.pop((sender, client_id), None)
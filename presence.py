@@ -0,0 +1,156 @@
+# PRESENCE
+#
+# Who is online is versioned: every user coming online or going offline bumps
+# a sequence number. Clients get one full snapshot when they log in, then
+# only the JOIN/LEAVE deltas, each tagged with its sequence number. A client
+# that sees a gap in the numbers asks for a fresh snapshot.
+#
+# With several nodes (see bus.py) a user is online while any node has a
+# session for them; NodeTable keeps track of which ones do.
+#
+# Typing indicators are aggregated per conversation instead of being relayed
+# keystroke by keystroke: TYPING messages only update who is typing where,
+# and a ticker sends one combined "who is typing" update per changed
+# conversation every TYPING_TICK seconds. Someone who stops sending TYPING is
+# dropped after TYPING_TTL seconds, whether or not their client says so.
+import threading
+import time
+
+from metrics import metrics
+
+class PresenceLog:
+    def __init__(self, publish):
+        self.publish = publish  # publish(kind, seq, username) announces a "JOIN" or "LEAVE"
+        # Held while publishing so every connection receives the deltas in
+        # sequence order; reentrant because a failed send removes the client
+        self.lock = threading.RLock()
+        self.seq = 0
+        self._online = {}  # {username: None}, an insertion-ordered set
+
+    def join(self, username):
+        with self.lock:
+            self.seq += 1
+            self._online[username] = None
+            self.publish("JOIN", self.seq, username)
+
+    def leave(self, username):
+        with self.lock:
+            if username not in self._online:
+                return
+            self.seq += 1
+            del self._online[username]
+            self.publish("LEAVE", self.seq, username)
+
+    def snapshot(self):
+        """(seq, online usernames); take self.lock to send it in order with the deltas"""
+        with self.lock:
+            return self.seq, tuple(self._online)
+
+class NodeTable:
+    """Which nodes each user is online on, when several servers share the chat.
+
+    A user is online while at least one node has a session for them. Not
+    thread-safe by itself; the server uses it with PresenceLog.lock held.
+    """
+
+    def __init__(self):
+        self._nodes = {}  # {username: set of node ids}
+        self._seen = {}  # {node id: time of its last message}
+
+    def add(self, node, username):
+        """Returns True if the user was offline on every node until now"""
+        nodes = self._nodes.setdefault(username, set())
+        first = not nodes
+        nodes.add(node)
+        return first
+
+    def remove(self, node, username):
+        """Returns True if the user is now offline on every node"""
+        nodes = self._nodes.get(username)
+        if not nodes or node not in nodes:
+            return False
+        nodes.discard(node)
+        if nodes:
+            return False
+        del self._nodes[username]
+        return True
+
+    def users_on(self, node):
+        return [username for username, nodes in self._nodes.items() if node in nodes]
+
+    def drop_node(self, node):
+        """Forget a dead node; returns the users that went offline with it"""
+        self._seen.pop(node, None)
+        return [username for username in self.users_on(node) if self.remove(node, username)]
+
+    def seen(self, node):
+        self._seen[node] = time.monotonic()
+
+    def silent(self, timeout):
+        """Nodes not heard from for timeout seconds"""
+        now = time.monotonic()
+        return [node for node, seen in self._seen.items() if now - seen > timeout]
+
+TYPING_TICK = 0.25
+TYPING_TTL = 3.0
+
+class TypingAggregator:
+    def __init__(self, emit, tick=TYPING_TICK, ttl=TYPING_TTL):
+        self.emit = emit  # emit(conversation, usernames) sends one combined update
+        self.tick = tick
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._typing = {}  # {conversation: {username: expiry}}
+        self._dirty = set()  # Conversations whose typists changed since the last tick
+
+    def update(self, username, conversation, typing):
+        """Record that username started (or stopped) typing in a conversation"""
+        metrics.incr("typing_events")
+        with self._lock:
+            if typing:
+                typists = self._typing.setdefault(conversation, {})
+                if username not in typists:
+                    self._dirty.add(conversation)
+                typists[username] = time.monotonic() + self.ttl
+                return
+            # Stopping never creates an entry; the last typist takes the conversation along
+            typists = self._typing.get(conversation)
+            if typists is not None and typists.pop(username, None) is not None:
+                self._dirty.add(conversation)
+                if not typists:
+                    del self._typing[conversation]
+
+    def forget(self, username):
+        """Drop a user from every conversation (e.g. when they go offline)"""
+        with self._lock:
+            for conversation, typists in list(self._typing.items()):
+                if typists.pop(username, None) is not None:
+                    self._dirty.add(conversation)
+                    if not typists:
+                        del self._typing[conversation]
+
+    def run(self):
+        """Send the combined updates, forever (run in a thread)"""
+        while True:
+            time.sleep(self.tick)
+            for conversation, usernames in self.collect():
+                metrics.incr("typing_updates")
+                self.emit(conversation, usernames)
+
+    def collect(self):
+        """Expire stale typists; return (conversation, usernames) for every change"""
+        now = time.monotonic()
+        with self._lock:
+            for conversation, typists in self._typing.items():
+                expired = [u for u, expiry in typists.items() if expiry <= now]
+                for username in expired:
+                    del typists[username]
+                if expired:
+                    self._dirty.add(conversation)
+            updates = [(c, sorted(self._typing.get(c, ()))) for c in self._dirty]
+            self._dirty.clear()
+            # Forget conversations nobody is typing in any more
+            for conversation, usernames in updates:
+                if not usernames:
+                    self._typing.pop(conversation, None)
+        return updates
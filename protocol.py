@@ -0,0 +1,233 @@
+# WIRE PROTOCOL (shared by client.py and server.py)
+#
+# Every message travels in a length-prefixed frame:
+#
+#   +-------+---------+-------+----------------+---------+
+#   | magic | version | flags | length (u32be) | payload |
+#   +-------+---------+-------+----------------+---------+
+#     0xFE    1 byte    1 byte     4 bytes      <length> bytes
+#
+# The payload is the familiar "TYPE|field|field..." text encoded as UTF-8.
+# Frames with FLAG_BINARY set carry raw bytes (file chunks) instead:
+#
+#   +-----------------------+-------------------+-----------+
+#   | header length (u16be) | "TYPE|field|..."  | raw bytes |
+#   +-----------------------+-------------------+-----------+
+#
+# 0xFE never appears in UTF-8 text, so the server can tell a framed client
+# from a legacy one (which opens with raw "username||password") by looking
+# at the first byte it receives.
+#
+# Payloads of COMPRESS_THRESHOLD bytes or more may be compressed, which
+# FLAG_ZLIB or FLAG_ZSTD records; binary frames are compressed whole (header
+# length, header and raw bytes). FrameParser always decompresses, so only
+# the sending side has to agree to it: after logging in, a client sends
+# COMPRESS|codec,... with the codecs it has and the server answers
+# COMPRESS|codec with the one both sides use from then on (or nothing).
+import struct
+import time
+import zlib
+
+from metrics import metrics
+
+MAGIC = 0xFE
+VERSION = 1
+HEADER = struct.Struct("!BBBI")
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Refuse anything larger than 16MB
+
+FLAG_BINARY = 0x01
+FLAG_ZLIB = 0x02
+FLAG_ZSTD = 0x04
+FLAG_COMPRESSED = FLAG_ZLIB | FLAG_ZSTD
+BINARY_HEADER = struct.Struct("!H")
+
+COMPRESS_THRESHOLD = 1024  # Smaller payloads are not worth compressing
+COMPRESS_LEVEL = 3  # 1 (fastest) to 9 (smallest)
+_CORRUPT = (zlib.error, ValueError)
+
+_zstandard = False  # The zstandard module once looked for; None if it is not installed
+
+def zstd():
+    """The zstandard module, or None; imported on first use to keep client startup fast"""
+    global _zstandard
+    if _zstandard is False:
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None  # zstd is optional; zlib is always available
+        _zstandard = zstandard
+    return _zstandard
+
+class ProtocolError(Exception):
+    """Raised when the peer sends bytes that are not a valid frame"""
+
+def is_framed(data):
+    """Return True if data (the first bytes from a peer) starts a frame"""
+    return len(data) > 0 and data[0] == MAGIC
+
+def encode_frame(payload, flags=0, compressor=None):
+    """Encode one message (str or bytes) as a frame, compressed if a compressor is given"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if compressor is not None:
+        flags, payload = compressor.compress(flags, payload)
+    return HEADER.pack(MAGIC, VERSION, flags, len(payload)) + payload
+
+def encode_binary_frame(header, data, compressor=None):
+    """Encode a text header plus raw bytes as a binary frame"""
+    header = header.encode()
+    length = BINARY_HEADER.size + len(header) + len(data)
+    if compressor is not None and length >= compressor.threshold:
+        return encode_frame(b"".join((BINARY_HEADER.pack(len(header)), header, data)), FLAG_BINARY, compressor)
+    return b"".join((HEADER.pack(MAGIC, VERSION, FLAG_BINARY, length),
+                     BINARY_HEADER.pack(len(header)), header, data))
+
+def available_codecs():
+    """Compression codecs this side supports, preferred first"""
+    return ["zstd", "zlib"] if zstd() is not None else ["zlib"]
+
+class Compressor:
+    """Compresses payloads of at least threshold bytes with one codec.
+
+    One instance can be shared by every connection (and thread) using the
+    same codec and level.
+    """
+
+    def __init__(self, codec, level=COMPRESS_LEVEL, threshold=COMPRESS_THRESHOLD):
+        if codec not in available_codecs():
+            raise ValueError(f"unsupported compression codec {codec!r}")
+        self.codec = codec
+        self.level = level
+        self.threshold = threshold
+        self.flag = FLAG_ZSTD if codec == "zstd" else FLAG_ZLIB
+
+    def compress(self, flags, payload):
+        """(flags, payload) to send: compressed unless it is too small or does not shrink"""
+        if len(payload) < self.threshold:
+            return flags, payload
+        started = time.perf_counter()
+        if self.codec == "zstd":
+            # ZstdCompressor objects must not be shared between threads
+            compressed = zstd().ZstdCompressor(level=self.level).compress(payload)
+        else:
+            compressed = zlib.compress(payload, self.level)
+        metrics.observe("compress", time.perf_counter() - started)
+        if len(compressed) >= len(payload):
+            metrics.incr("compress_skipped")  # Already compressed data, e.g. a JPEG
+            return flags, payload
+        metrics.incr("compress_bytes_saved", len(payload) - len(compressed))
+        return flags | self.flag, compressed
+
+    def compress_frame(self, frame):
+        """Compress an already encoded, uncompressed frame"""
+        _, _, flags, _ = HEADER.unpack_from(frame)
+        flags, payload = self.compress(flags, memoryview(frame)[HEADER.size:])
+        return HEADER.pack(MAGIC, VERSION, flags, len(payload)) + payload
+
+def decompress(flags, payload, max_size):
+    """Payload of a compressed frame, refusing to inflate past max_size bytes"""
+    started = time.perf_counter()
+    try:
+        if flags & FLAG_ZSTD:
+            zstandard = zstd()
+            if zstandard is None:
+                raise ProtocolError("zstd frame received but zstandard is not installed")
+            try:
+                with zstandard.ZstdDecompressor().stream_reader(bytes(payload)) as reader:
+                    data = reader.read(max_size + 1)
+            except zstandard.ZstdError as e:
+                raise ProtocolError(f"corrupt compressed frame: {e}")
+        else:
+            inflater = zlib.decompressobj()
+            data = inflater.decompress(payload, max_size + 1)
+    except _CORRUPT as e:
+        raise ProtocolError(f"corrupt compressed frame: {e}")
+    if len(data) > max_size:
+        raise ProtocolError(f"compressed frame inflates past {max_size} bytes")
+    metrics.observe("decompress", time.perf_counter() - started)
+    return data
+
+class BinaryMessage:
+    """A received binary frame.
+
+    frame holds the complete frame (header included), copied out of the
+    parser once, so it can be relayed to other peers exactly as it arrived.
+    data is a zero-copy view of the raw bytes inside it.
+    """
+    __slots__ = ("header", "frame", "_offset")
+
+    def __init__(self, flags, payload):
+        (length,) = BINARY_HEADER.unpack_from(payload)
+        if BINARY_HEADER.size + length > len(payload):
+            raise ProtocolError("binary header exceeds frame")
+        self.header = str(payload[BINARY_HEADER.size:BINARY_HEADER.size + length], "utf-8", "ignore")
+        self.frame = HEADER.pack(MAGIC, VERSION, flags, len(payload)) + payload
+        self._offset = HEADER.size + BINARY_HEADER.size + length
+
+    @property
+    def data(self):
+        return memoryview(self.frame)[self._offset:]
+
+class FrameParser:
+    """Incremental frame parser.
+
+    Received bytes are appended with feed(); frames() then yields every
+    complete frame as (flags, payload) where payload is a memoryview into
+    the parser's buffer. No bytes are copied per frame, so a read holding
+    dozens of pipelined messages is parsed in one pass. A payload view is
+    only valid until the generator advances; copy it if you need to keep it.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._pos = 0  # Start of the first unparsed frame in _buffer
+
+    def feed(self, data):
+        # Drop frames that were already handed out before appending
+        if self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        self._buffer += data
+
+    def pending(self):
+        """Number of buffered bytes that do not yet form a complete frame"""
+        return len(self._buffer) - self._pos
+
+    def frames(self):
+        buffer = self._buffer
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - self._pos >= HEADER.size:
+                magic, version, flags, length = HEADER.unpack_from(buffer, self._pos)
+                if magic != MAGIC:
+                    raise ProtocolError(f"bad frame magic 0x{magic:02x}")
+                if version > VERSION:
+                    raise ProtocolError(f"unsupported protocol version {version}")
+                if length > self.max_frame_size:
+                    raise ProtocolError(f"frame of {length} bytes exceeds limit")
+
+                start = self._pos + HEADER.size
+                end = start + length
+                if end > len(buffer):
+                    break  # Wait for the rest of this frame
+
+                self._pos = end
+                payload = view[start:end]
+                try:
+                    yield flags, payload
+                finally:
+                    payload.release()
+        finally:
+            view.release()
+
+    def messages(self):
+        """Yield every complete frame: text frames as str, binary ones as BinaryMessage"""
+        for flags, payload in self.frames():
+            if flags & FLAG_COMPRESSED:
+                payload = decompress(flags, payload, self.max_frame_size)
+                flags &= ~FLAG_COMPRESSED
+            if flags & FLAG_BINARY:
+                yield BinaryMessage(flags, payload)
+            else:
+                yield str(payload, "utf-8", "ignore")
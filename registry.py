@@ -0,0 +1,62 @@
+# CONNECTION REGISTRY
+#
+# Index of every logged-in session, keyed both ways: connection -> username
+# and username -> sessions. A user may be logged in from several devices at
+# once, so a username maps to a tuple of connections.
+#
+# Changes (add/remove) take a lock and publish fresh immutable tuples.
+# Readers never lock: fan-out loops iterate a snapshot tuple, which stays
+# valid while other threads connect and disconnect.
+import threading
+
+class ConnectionRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usernames = {}  # {connection: username}
+        self._sessions = {}  # {username: (connection, ...)}
+        self._connections = ()  # Snapshot of every connection
+
+    def add(self, connection, username):
+        """Register a session; returns True if it is the user's first one"""
+        with self._lock:
+            self._usernames[connection] = username
+            sessions = self._sessions.get(username, ())
+            self._sessions[username] = sessions + (connection,)
+            self._connections = self._connections + (connection,)
+            return not sessions
+
+    def remove(self, connection):
+        """Unregister a session.
+
+        Returns (username, last_session) where last_session tells whether
+        the user is now offline, or (None, False) if the connection was not
+        registered (e.g. it was already removed by another thread).
+        """
+        with self._lock:
+            username = self._usernames.pop(connection, None)
+            if username is None:
+                return None, False
+            sessions = tuple(c for c in self._sessions[username] if c is not connection)
+            if sessions:
+                self._sessions[username] = sessions
+            else:
+                del self._sessions[username]
+            self._connections = tuple(c for c in self._connections if c is not connection)
+            return username, not sessions
+
+    def username(self, connection, default=None):
+        return self._usernames.get(connection, default)
+
+    def sessions(self, username):
+        """All sessions of one user (empty tuple if offline)"""
+        return self._sessions.get(username, ())
+
+    def connections(self):
+        """Snapshot of every registered connection"""
+        return self._connections
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __contains__(self, connection):
+        return connection in self._usernames
@@ -0,0 +1,75 @@
+# ROOMS
+#
+# Named rooms ("#name") next to the implicit "Everyone" audience. Each
+# session joins the rooms it wants; a room message is only sent to the
+# sessions subscribed to that room, so fan-out is proportional to the size
+# of the room rather than to the number of users online.
+#
+# Like ConnectionRegistry, changes take a lock and publish fresh tuples, so
+# fan-out loops iterate a snapshot without locking.
+import re
+import threading
+
+ROOM_PREFIX = "#"
+ROOM_NAME = re.compile(r"#[\w-]{1,32}")
+
+def is_room(recipient):
+    return recipient.startswith(ROOM_PREFIX)
+
+class RoomRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members = {}  # {room: (connection, ...)}
+        self._rooms = {}  # {connection: frozenset of rooms}
+
+    def join(self, room, connection):
+        """Subscribe a session to a room; returns False if it already was"""
+        with self._lock:
+            members = self._members.get(room, ())
+            if connection in members:
+                return False
+            self._members[room] = members + (connection,)
+            self._rooms[connection] = self._rooms.get(connection, frozenset()) | {room}
+            return True
+
+    def leave(self, room, connection):
+        """Unsubscribe a session from a room; returns False if it was not a member"""
+        with self._lock:
+            return self._leave(room, connection)
+
+    def leave_all(self, connection):
+        """Unsubscribe a closed session from every room; returns the rooms it was in"""
+        with self._lock:
+            rooms = self._rooms.get(connection, frozenset())
+            for room in rooms:
+                self._leave(room, connection)
+            return rooms
+
+    def _leave(self, room, connection):
+        members = self._members.get(room, ())
+        if connection not in members:
+            return False
+        members = tuple(c for c in members if c is not connection)
+        if members:
+            self._members[room] = members
+        else:
+            del self._members[room]
+        rooms = self._rooms[connection] - {room}
+        if rooms:
+            self._rooms[connection] = rooms
+        else:
+            del self._rooms[connection]
+        return True
+
+    def sessions(self, room):
+        """Snapshot of the sessions subscribed to a room"""
+        return self._members.get(room, ())
+
+    def rooms_of(self, connection):
+        """Rooms a session has joined"""
+        return self._rooms.get(connection, frozenset())
+
+    def active_rooms(self):
+        """Rooms with at least one member"""
+        with self._lock:
+            return sorted(self._members)
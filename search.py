@@ -0,0 +1,180 @@
+# IN-PROCESS SEARCH INDEX
+#
+# SEARCH used to run a MongoDB $text query per request. The server now keeps
+# an inverted index (word -> message ids) over the latest SEARCH_CAPACITY
+# chat messages, updated as messages are sent:
+#
+#   - every search word matches as a prefix ("crypt" finds "cryptography")
+#     and a message must contain all of them
+#   - results are filtered to what the requesting user may see: public and
+#     their own private messages, plus the rooms the requesting session has
+#     joined, or only one of those rooms
+#   - results are cached per (user, query) and a cached entry is dropped as
+#     soon as a new message it would match arrives
+#
+# Messages older than the index are only searched in MongoDB, and only when
+# the index cannot fill a whole page of results.
+import bisect
+import re
+import threading
+from collections import OrderedDict
+
+from history import to_json, json_arrays
+from rooms import is_room
+
+SEARCH_CAPACITY = 100000  # Messages kept in the index
+SEARCH_LIMIT = 20  # Results per search
+
+_WORD = re.compile(r"\w+")
+
+def tokenize(text):
+    return set(_WORD.findall(text.lower()))
+
+class SearchRecord:
+    __slots__ = ("id", "sender", "recipient", "words", "json")
+
+    def __init__(self, document):
+        self.id = document["_id"]
+        self.sender = document["sender"]
+        self.recipient = document["recipient"]
+        self.words = tokenize(document["content"])
+        self.json = to_json(document)
+
+    def visible_to(self, username, rooms=frozenset(), room=None):
+        if room is not None:
+            return self.recipient == room
+        if self.recipient in rooms:
+            return True
+        if is_room(self.recipient):
+            return False  # A room the user is not in, even if they wrote the message
+        return self.recipient == "Everyone" or username == self.sender or username == self.recipient
+
+    def matches(self, terms):
+        return all(any(word.startswith(term) for word in self.words) for term in terms)
+
+class SearchIndex:
+    def __init__(self, capacity=SEARCH_CAPACITY, limit=SEARCH_LIMIT, cache_size=256):
+        self.capacity = capacity
+        self.limit = limit
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._records = OrderedDict()  # {seq: SearchRecord}, oldest first
+        self._postings = {}  # {word: set of seq}
+        self._seq = 0  # Posting key; small ints intersect and sort much faster than ObjectIds
+        self._vocabulary = []  # Sorted words, for prefix lookups
+        self._cache = OrderedDict()  # {(username, terms, rooms, room): JSON arrays}, least recently used first
+        self.complete = True  # False once messages exist that are not in the index
+        self._generation = 0  # Bumped by add(), so a search racing it is not cached
+
+    def load(self, documents, complete):
+        """Seed the index (oldest first); complete says whether that was everything"""
+        for document in documents:
+            self.add(document)
+        self.complete = self.complete and complete
+
+    def add(self, document):
+        """Index a chat message; other document types are ignored"""
+        if document.get("type") != "message" or not document.get("content"):
+            return
+        record = SearchRecord(document)
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._records[seq] = record
+            for word in record.words:
+                ids = self._postings.get(word)
+                if ids is None:
+                    ids = self._postings[word] = set()
+                    bisect.insort(self._vocabulary, word)
+                ids.add(seq)
+            self._generation += 1
+            if len(self._records) > self.capacity:
+                self._evict()
+            # Drop cached results this message could change
+            for key in [key for key in self._cache
+                        if record.visible_to(key[0], key[2], key[3]) and record.matches(key[1])]:
+                del self._cache[key]
+
+    def search(self, username, query, fallback, rooms=frozenset(), room=None):
+        """The newest messages matching query that username may see, as a tuple of JSON arrays.
+
+        rooms are the rooms whose messages username may see as well; if room
+        is given, only that room is searched. fallback(username, query,
+        before_id, limit) is called when the index runs out of matches but
+        older messages exist, and must return matching documents older than
+        before_id (newest first, before_id may be None) from the database.
+        """
+        terms = tuple(sorted(tokenize(query)))
+        if not terms:
+            return ("[]",)
+        key = (username, terms, rooms, room)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+            results = self._match(key)
+            oldest = next(iter(self._records.values()), None)
+            complete = self.complete
+            generation = self._generation
+
+        found = [record.json for record in results]
+        if len(found) < self.limit and not complete:
+            before_id = oldest.id if oldest is not None else None
+            documents = fallback(username, query, before_id, self.limit - len(found))
+            found += [to_json(document) for document in documents]
+        payload = tuple(json_arrays(found))
+
+        with self._lock:
+            if generation != self._generation:
+                return payload
+            self._cache[key] = payload
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return payload
+
+    def _match(self, key):
+        """Newest visible records containing every term as a word prefix"""
+        username, terms, rooms, room = key
+        # Find the vocabulary range each term covers, narrowest first
+        vocabulary = self._vocabulary
+        ranges = []
+        for term in terms:
+            start = bisect.bisect_left(vocabulary, term)
+            end = bisect.bisect_left(vocabulary, term + "\uffff", start)
+            if start == end:
+                return []
+            ranges.append((end - start, start, end, term))
+        ranges.sort()
+
+        candidates = None
+        for width, start, end, term in ranges:
+            if candidates is not None and len(candidates) < width:
+                # Cheaper to check the few candidates than to merge postings
+                candidates = {seq for seq in candidates
+                              if any(word.startswith(term) for word in self._records[seq].words)}
+            else:
+                ids = set()
+                for word in vocabulary[start:end]:
+                    ids |= self._postings[word]
+                candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
+        results = []
+        for seq in sorted(candidates, reverse=True):
+            record = self._records[seq]
+            if record.visible_to(username, rooms, room):
+                results.append(record)
+                if len(results) == self.limit:
+                    break
+        return results
+
+    def _evict(self):
+        seq, record = self._records.popitem(last=False)
+        for word in record.words:
+            ids = self._postings[word]
+            ids.discard(seq)
+            if not ids:
+                del self._postings[word]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, word)]
+        self.complete = False
@@ -1,394 +1,1626 @@
 # SERVER CODE (s2_.py)
 import socket
 import threading
+import asyncio
+import argparse
 import bcrypt
-import json
-from pymongo import MongoClient
+import base64
+import functools
+from pymongo import MongoClient, UpdateOne
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
 from datetime import datetime
 import time
 import ssl  # Add SSL support
+import os
+import signal
+import uuid
+import ipaddress
+from fractions import Fraction
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from metrics import metrics, format_snapshot
+from registry import ConnectionRegistry
+from protocol import (FrameParser, BinaryMessage, Compressor, encode_frame, encode_binary_frame, is_framed,
+                      available_codecs, COMPRESS_LEVEL, COMPRESS_THRESHOLD)
+from persistence import MessageWriter, RecentIds, PERSIST_MODES, DEDUP_CAPACITY
+from history import HistoryCache, HISTORY_LIMIT, HISTORY_PROJECTION, TIMESTAMP_FORMAT, to_json, json_arrays
+from search import SearchIndex, SEARCH_CAPACITY
+from filestore import FileStore, ShareLog, StoreError
+from presence import PresenceLog, NodeTable, TypingAggregator, TYPING_TICK
+from rooms import RoomRegistry, ROOM_NAME, ROOM_PREFIX, is_room
+from bus import open_bus
+from loginwait import LoginWaiter
+from auth import TokenSigner, RateLimiter, load_secret
 
 HOST= '127.0.0.1'
 PORT = 5001
 
-# Create socket
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind((HOST, PORT))
-server.listen()
-
-# Wrap socket with SSL/TLS
-context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-try:
-    context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
-    server = context.wrap_socket(server, server_side=True)
-    print("✅ SSL/TLS encryption enabled")
-except FileNotFoundError:
-    print("⚠️ SSL certificate files not found. Running without encryption.")
-    print("   Generate certificates with: openssl req -x509 -newkey rsa:4096 -keyout key.pem -out cert.pem -days 365 -nodes")
-except ssl.SSLError as e:
-    print(f"⚠️ SSL configuration error: {e}")
-    print("   Running without encryption.")
-
-print(f"✅ Server started on {HOST}:{PORT}")
-
-clients = {}  # {client_socket: username}
-file_transfers = {}  # Track ongoing file transfers
-
-# Connect to MongoDB
-try:
-    client_mongo = MongoClient('mongodb://localhost:27017/', serverSelectionTimeoutMS=5000)
-    client_mongo.server_info()  # Will raise exception if connection fails
-    db = client_mongo['chat_app']
-    users_collection = db['users']
-    messages_collection = db['messages']
-    
-    # Create indexes
-    messages_collection.create_index([("content", "text")])
-    print("✅ Connected to MongoDB")
-except Exception as e:
-    print(f"❌ MongoDB connection error: {str(e)}")
-    exit(1)
-
-def broadcast_users_list():
-    """Send the list of online users to all clients"""
-    users = list(clients.values())
-    users_msg = "USERS_LIST|" + "|".join(users)
-    
-    for client in clients:
+# Server engine: "threaded" (one thread per client) or "asyncio" (single event loop)
+SERVER_MODE = "threaded"
+SERVER_MODES = ("threaded", "asyncio")
+
+# Message types whose handlers talk to MongoDB; the asyncio engine runs these
+# in a worker thread so the event loop never blocks on the database
+BLOCKING_MESSAGE_TYPES = {"HISTORY_REQUEST", "SEARCH", "FILE_OFFER", "FILE_CHUNK", "FILE_FETCH", "ROOM_JOIN"}
+# Message types that are persisted; these only block when the persistence
+# mode waits for the database
+PERSISTED_MESSAGE_TYPES = {"MSG", "PRIVATE", "FILE_INFO"}
+
+# Authentication pipeline. TLS handshakes and logins run on a pool of
+# worker threads instead of the accept loop, and bcrypt runs in a process
+# pool so it can use every core.
+MAX_PENDING_AUTH = 256      # Connections allowed to be handshaking/authenticating at once
+AUTH_WORKERS = 32           # Threads serving handshakes and logins (threaded engine; not held while awaiting the login)
+HASH_WORKERS = os.cpu_count() or 1  # Processes running bcrypt
+LOGIN_TIMEOUT = 10          # Seconds a client gets to finish the TLS handshake and log in
+METRICS_INTERVAL = 30       # Seconds between metrics log lines (0 disables)
+
+# Outbound queues. Typing updates are dropped once a client's queue is full;
+# if it is still full after that, the client is disconnected.
+OUTBOX_MAX_BYTES = 4 * 1024 * 1024
+# Legacy clients take each recv() for exactly one message, so they get one
+# write per message with a short pause in between, instead of a batch that
+# would arrive as a single read.
+LEGACY_WRITE_GAP = 0.01
+
+# File store (see filestore.py). Senders upload each file once; recipients
+# fetch it from disk with FILE_FETCH at their own pace.
+FILE_STORE_DIR = "file_store"
+MAX_FILE_SIZE = 1024 * 1024 * 1024  # Largest upload accepted (client.MAX_FILE_SIZE matches it)
+FILE_FETCH_MAX = 1024 * 1024      # Largest range one FILE_FETCH may ask for (well below OUTBOX_MAX_BYTES)
+FILE_DATA_CHUNK = 256 * 1024      # Bytes per FILE_DATA frame
+LEGACY_FILE_CHUNK = 3072          # Bytes per base64 FILE_CHUNK pushed to legacy clients (4096 characters)
+PARTIAL_QUOTA = 2 * MAX_FILE_SIZE  # Bytes of unfinished uploads one user may have in the store
+PARTIAL_TTL = 24 * 60 * 60        # Seconds an unfinished upload is kept for a resume after its last chunk
+PARTIAL_SWEEP_INTERVAL = 10 * 60  # Seconds between sweeps for expired unfinished uploads
+
+# Several nodes (server processes) can share one chat through a message bus
+# (see bus.py). "local://" runs a single node; "tcp://host:port" or
+# "unix:///path" joins the other nodes through a broker.
+BUS_ADDRESS = "local://"
+NODE_ID = uuid.uuid4().hex[:12]  # This node's name on the bus
+NODE_HEARTBEAT = 2  # Seconds between heartbeats on the bus
+NODE_TIMEOUT = 10   # A node silent for this long is taken for dead and its users go offline
+
+# Message persistence (see persistence.py). "async" queues messages and writes
+# them in batches, "batched" also waits for the batch to be stored, "sync"
+# inserts every message on the sender's thread.
+PERSIST_MODE = "async"
+PERSIST_BATCH_SIZE = 500        # Flush once this many messages are queued...
+PERSIST_FLUSH_INTERVAL = 0.05   # ...or this many seconds after the first one
+PERSIST_QUEUE_SIZE = 50000      # Senders wait once this many are unwritten
+
+# TLS. Either certificate may be missing; with both, OpenSSL uses the ECDSA
+# one for clients that support it, whose handshakes cost far less CPU than
+# RSA-4096. Session tickets let a reconnecting client resume its previous
+# session instead of doing a full handshake.
+TLS_CERTIFICATES = (("cert.pem", "key.pem"),              # RSA
+                    ("ecdsa_cert.pem", "ecdsa_key.pem"))  # ECDSA (P-256)
+TLS_SESSION_TICKETS = 2  # Tickets issued per TLS 1.3 handshake
+
+# Logins. A password login returns a session token that later logins can
+# present instead (see auth.py); password logins and signups are throttled
+# per IP address and per username before bcrypt runs. Loopback addresses
+# skip the per-IP buckets, since every local client (or every client of a
+# reverse proxy on this host) shares one.
+SESSION_SECRET_FILE = "session_secret.key"  # Token signing key, created on first start
+SESSION_SECRET_ENV = "CRYPTOCHAT_SESSION_SECRET"  # Overrides the file; give every node the same one
+LOGIN_RATE_PER_IP = (0.5, 10)  # (password logins per second, burst)
+LOGIN_RATE_PER_USER = (0.2, 5)
+SIGNUP_RATE_PER_IP = (1 / 60, 3)
+THROTTLE_LOOPBACK = False  # Apply the per-IP buckets to 127.0.0.1 and ::1 too
+
+ssl_context = None  # SSL/TLS context, shared by both engines (None when running unencrypted)
+password_pool = None  # ProcessPoolExecutor for bcrypt, created at startup
+message_writer = None  # MessageWriter for chat history, created at startup
+recent_ids = None  # RecentIds of client message ids already accepted, created at startup
+history_cache = None  # HistoryCache answering HISTORY_REQUEST, created at startup
+search_index = None  # SearchIndex answering SEARCH, created at startup
+file_store = None  # FileStore for uploaded files, created at startup
+presence = None  # PresenceLog of online users, created at startup
+typing_aggregator = None  # TypingAggregator combining TYPING updates, created at startup
+bus = None  # Message bus to the other nodes, created at startup
+token_signer = None  # TokenSigner for session tokens, created at startup
+compressors = {}  # {codec: Compressor} shared by the clients using that codec, filled at startup
+
+registry = ConnectionRegistry()  # Every logged-in session, by connection and by username
+login_waiter = LoginWaiter()  # Connections yet to send their login (threaded engine)
+file_shares = ShareLog()  # Latest file records, for FILE_FETCH access checks before MongoDB has them
+rooms = RoomRegistry()  # Room subscriptions, by room and by connection
+nodes = NodeTable()  # Which nodes each online user is connected to (guarded by presence.lock)
+ip_logins = None  # RateLimiter for password logins and signups, by IP address, created at startup
+user_logins = None  # RateLimiter for password logins and signups, by username, created at startup
+ip_signups = None  # RateLimiter for new accounts, by IP address, created at startup
+
+def parse_rate(text):
+    """--*-rate value "RATE,BURST" -> (attempts per second, burst); RATE may be a fraction like 1/60"""
+    try:
+        rate, burst = text.split(",")
+        return float(Fraction(rate)), int(burst)
+    except (ValueError, ZeroDivisionError):
+        raise argparse.ArgumentTypeError(f"expected RATE,BURST (e.g. 0.5,10 or 1/60,3), got {text!r}")
+
+def throttles(address):
+    """True if the per-IP login buckets apply to address"""
+    if THROTTLE_LOOPBACK:
+        return True
+    try:
+        return not ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return True
+
+def load_ssl_context():
+    """Load the server certificates, or return None to run unencrypted"""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    loaded = []
+    for certfile, keyfile in TLS_CERTIFICATES:
         try:
-            client.send(users_msg.encode())
-        except:
-            client.close()
-            remove_client(client)
+            context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+            loaded.append(certfile)
+        except FileNotFoundError:
+            pass
+        except ssl.SSLError as e:
+            print(f"⚠️ SSL configuration error in {certfile}: {e}")
+    if not loaded:
+        print("⚠️ SSL certificate files not found. Running without encryption.")
+        print("   Generate certificates with: openssl req -x509 -newkey ec -pkeyopt ec_paramgen_curve:prime256v1 "
+              "-keyout ecdsa_key.pem -out ecdsa_cert.pem -days 365 -nodes")
+        return None
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = TLS_SESSION_TICKETS
+    print(f"✅ SSL/TLS encryption enabled ({', '.join(loaded)})")
+    return context
+
+def record_handshake(ssl_object, seconds=None):
+    """Count one TLS handshake, and time it if seconds is known, split by whether the client resumed a session"""
+    kind = "resumed" if ssl_object.session_reused else "full"
+    metrics.incr(f"tls_{kind}")
+    if seconds is not None:
+        metrics.observe(f"tls_handshake_{kind}", seconds)
+
+def connect_database():
+    """Connect to MongoDB and set up the collections used by the handlers"""
+    global client_mongo, db, users_collection, messages_collection
+    try:
+        client_mongo = MongoClient('mongodb://localhost:27017/', serverSelectionTimeoutMS=5000)
+        client_mongo.server_info()  # Will raise exception if connection fails
+        db = client_mongo['chat_app']
+        users_collection = db['users']
+        messages_collection = db['messages']
+        
+        # Create indexes. History and search select on recipient or sender
+        # and walk backwards by _id, so each branch of their $or has an index.
+        messages_collection.create_index([("content", "text")])
+        messages_collection.create_index([("recipient", 1), ("_id", -1)])
+        messages_collection.create_index([("sender", 1), ("_id", -1)])
+        # FILE_FETCH checks who a stored file was shared with
+        messages_collection.create_index([("sha256", 1)], sparse=True)
+        # A message resent after a reconnect is stored once
+        messages_collection.create_index([("sender", 1), ("client_id", 1)], unique=True,
+                                         partialFilterExpression={"client_id": {"$exists": True}})
+        print("✅ Connected to MongoDB")
+    except Exception as e:
+        print(f"❌ MongoDB connection error: {str(e)}")
+        exit(1)
+
+def parse_timestamp(text):
+    """Parse a wire timestamp, falling back to the current time"""
+    try:
+        return datetime.strptime(text, TIMESTAMP_FORMAT)
+    except ValueError:
+        return datetime.now()
+
+def migrate_timestamps(batch_size=1000):
+    """Convert timestamps stored as strings by older servers into datetimes"""
+    migrated = skipped = 0
+    updates = []
+    for doc in messages_collection.find({"timestamp": {"$type": "string"}}, {"timestamp": 1}):
+        try:
+            timestamp = datetime.strptime(doc["timestamp"], TIMESTAMP_FORMAT)
+        except ValueError:
+            skipped += 1
+            continue
+        updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"timestamp": timestamp}}))
+        if len(updates) == batch_size:
+            migrated += messages_collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        migrated += messages_collection.bulk_write(updates, ordered=False).modified_count
+    if migrated or skipped:
+        print(f"🔧 Migrated {migrated} message timestamps to datetimes ({skipped} unparseable left as is)")
+
+def visible_to(username, joined=(), room=None):
+    """Query matching every message username is allowed to see.
+
+    joined are the rooms whose messages are visible too; if room is given,
+    only that room's messages match.
+    """
+    if room is not None:
+        return {"recipient": room}
+    query = {"$or": [
+        {"recipient": "Everyone"},
+        {"recipient": username},
+        {"sender": username, "room": {"$exists": False}}
+    ]}
+    if joined:
+        query["$or"].append({"recipient": {"$in": list(joined)}})
+    return query
+
+def may_fetch(client, username, digest):
+    """True if a file record with this digest is visible to username (see visible_to)"""
+    joined = rooms.rooms_of(client)
+    for sender, recipient in file_shares.shares(digest):
+        if recipient in ("Everyone", username) or recipient in joined or (sender == username and not is_room(recipient)):
+            return True
+    query = visible_to(username, joined)
+    query.update({"type": "file", "sha256": digest})
+    return messages_collection.find_one(query, {"_id": 1}) is not None
+
+def load_history_page(username, before_id, limit=HISTORY_LIMIT):
+    """The limit messages visible to username just before before_id, oldest first.
+
+    Keyset pagination: each page continues from the _id where the previous
+    one ended, so it costs the same however far back the client scrolls.
+    """
+    query = visible_to(username)
+    query["_id"] = {"$lt": before_id}
+    page = list(messages_collection.find(query, HISTORY_PROJECTION).sort("_id", -1).limit(limit))
+    page.reverse()
+    return page
+
+def load_recent_ids():
+    """Remember the client ids of the latest messages, so resends survive a restart"""
+    ids = RecentIds(DEDUP_CAPACITY)
+    latest = list(messages_collection.find({"client_id": {"$exists": True}}, {"sender": 1, "client_id": 1})
+                  .sort("_id", -1).limit(DEDUP_CAPACITY))
+    for document in reversed(latest):
+        ids.add(document["sender"], document["client_id"])
+    return ids
+
+def load_history_cache():
+    """Build the recent-history cache, seeded with the latest public messages"""
+    cache = HistoryCache(HISTORY_LIMIT, wrap=lambda text: Message(f"HISTORY|{text}"))
+    latest = list(messages_collection.find({"recipient": "Everyone"}, HISTORY_PROJECTION)
+                  .sort("_id", -1).limit(HISTORY_LIMIT))
+    cache.load_public(reversed(latest))
+    return cache
+
+def load_private_history(username, limit):
+    """A user's latest private messages, for the history cache"""
+    return list(messages_collection.find(
+        {"recipient": {"$ne": "Everyone"},
+         "room": {"$exists": False},
+         "$or": [
+             {"recipient": username},
+             {"sender": username}
+         ]},
+        HISTORY_PROJECTION
+    ).sort("_id", -1).limit(limit))
+
+def load_room_history(room, limit):
+    """A room's latest messages, for the history cache"""
+    return list(messages_collection.find({"recipient": room}, HISTORY_PROJECTION).sort("_id", -1).limit(limit))
+
+def load_search_index():
+    """Build the search index over the latest SEARCH_CAPACITY messages"""
+    index = SearchIndex(SEARCH_CAPACITY)
+    latest = list(messages_collection.find({"type": "message"}, HISTORY_PROJECTION)
+                  .sort("_id", -1).limit(SEARCH_CAPACITY))
+    index.load(reversed(latest), complete=len(latest) < SEARCH_CAPACITY)
+    return index
+
+def search_archive(username, search_term, before_id, limit, joined=(), room=None):
+    """$text search over messages older than the search index"""
+    query = visible_to(username, joined, room)
+    query["$text"] = {"$search": search_term}
+    if before_id is not None:
+        query["_id"] = {"$lt": before_id}
+    return list(messages_collection.find(query, HISTORY_PROJECTION).sort("_id", -1).limit(limit))
+
+def store_message(document):
+    """Persist a message and add it to the history cache and search index"""
+    if is_room(document["recipient"]):
+        document["room"] = document["recipient"]  # Keeps room messages out of private history
+    message_writer.write(document)
+    history_cache.add(document)
+    search_index.add(document)
+    if "sha256" in document:
+        file_shares.add(document)
+    # Format: STORED|node, payload: the document as extended JSON
+    bus.publish(f"STORED|{NODE_ID}", json_util.dumps(document).encode())
+
+def check_password(password, stored_password):
+    """bcrypt check, run in password_pool"""
+    # Handle both string and bytes format for stored password
+    if isinstance(stored_password, str):
+        stored_password = stored_password.encode()
+    return bcrypt.checkpw(password.encode(), stored_password)
+
+def hash_password(password):
+    """bcrypt hash for a new account, run in password_pool"""
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+def report_metrics():
+    """Print a metrics line every METRICS_INTERVAL seconds"""
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        connections = registry.connections()
+        metrics.set_gauge("clients", len(connections))
+        depths = [len(c.outbox) for c in connections]
+        metrics.set_gauge("outbox_max_depth", max(depths, default=0))
+        metrics.set_gauge("outbox_bytes", sum(c.outbox.bytes for c in connections))
+        metrics.set_gauge("persist_queue", message_writer.pending())
+        metrics.set_gauge("logins_waiting", len(login_waiter))
+        print(f"📊 {format_snapshot(metrics.snapshot())}")
+
+class Message:
+    """An outgoing message, encoded at most once per wire format.
+
+    Fan-out loops build one Message and send it to every recipient, so a
+    broadcast encodes the text once no matter how many clients receive it.
+    Droppable messages (typing updates) are the first thing discarded when
+    a recipient falls behind. Large messages are compressed once per codec
+    for the clients that negotiated compression.
+    """
+    __slots__ = ("text", "droppable", "_framed", "_legacy", "_compressed")
+
+    def __init__(self, text, droppable=False):
+        self.text = text
+        self.droppable = droppable
+        self._framed = None
+        self._legacy = None
+        self._compressed = None  # {Compressor: frame}
+
+    def encode(self, framed, compressor=None):
+        if framed:
+            if self._framed is None:
+                self._framed = encode_frame(self.text)
+            if compressor is None or len(self._framed) < compressor.threshold:
+                return self._framed
+            if self._compressed is None:
+                self._compressed = {}
+            frame = self._compressed.get(compressor)
+            if frame is None:
+                frame = self._compressed[compressor] = compressor.compress_frame(self._framed)
+            return frame
+        if self._legacy is None:
+            self._legacy = self.text.encode()
+        return self._legacy
+
+class BinaryRelay(Message):
+    """A binary frame (file chunk) relayed exactly as it was received.
+
+    Framed clients get the received frame bytes, shared by every recipient.
+    Legacy clients cannot take binary frames, so they get the old
+    "FILE_CHUNK|sender|recipient|file_name|chunk_num|total_chunks|base64"
+    text, built once on first use.
+    """
+    __slots__ = ("binary",)
+
+    def __init__(self, binary):
+        super().__init__(binary.header)
+        self.binary = binary
+        self._framed = binary.frame
+
+    def encode(self, framed, compressor=None):
+        if not framed and self._legacy is None:
+            header = "|".join(self.text.split("|")[:6])  # Without the fields legacy clients predate
+            self._legacy = f"{header}|{base64.b64encode(self.binary.data).decode()}".encode()
+        return super().encode(framed, compressor)
+
+class Outbox:
+    """Bounded queue of encoded messages waiting to be written to one client.
+
+    Not thread-safe by itself; each engine guards it (a lock for the
+    threaded engine, the event loop for the asyncio one).
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.queue = deque()  # [(data, droppable)]
+        self.bytes = 0
+        self.high_water = 0  # Deepest the queue has been, in messages
+        self.dropped = 0  # Droppable messages discarded because the client was behind
+
+    def put(self, data, droppable):
+        """Queue data; returns False if the client is too far behind to keep"""
+        if self.bytes + len(data) > self.max_bytes:
+            if droppable:
+                self.dropped += 1
+                metrics.incr("outbox_dropped")
+                return True
+            self._discard_droppable()
+            if self.bytes + len(data) > self.max_bytes:
+                return False
+        self.queue.append((data, droppable))
+        self.bytes += len(data)
+        if len(self.queue) > self.high_water:
+            self.high_water = len(self.queue)
+        return True
+
+    def _discard_droppable(self):
+        kept = deque(item for item in self.queue if not item[1])
+        discarded = len(self.queue) - len(kept)
+        if discarded:
+            self.dropped += discarded
+            metrics.incr("outbox_dropped", discarded)
+            self.queue = kept
+            self.bytes = sum(len(data) for data, _ in kept)
+
+    def take_all(self):
+        """Remove and return every queued message, oldest first"""
+        batch = [data for data, _ in self.queue]
+        self.queue.clear()
+        self.bytes = 0
+        return batch
+
+    def __len__(self):
+        return len(self.queue)
+
+class Connection:
+    """A connected client as seen by the message handlers.
+
+    Each server engine provides a subclass. Handlers only call send() and
+    close(), so the same handler code runs under either engine. send()
+    only appends to the connection's Outbox; a per-connection writer does
+    the actual network writes, so one slow client never stalls a sender.
+    """
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.closed = False
+        self.parser = None  # FrameParser once the client is known to speak framed protocol
+        self.compressor = None  # Compressor for large frames, once negotiated with COMPRESS
+        self.outbox = Outbox(OUTBOX_MAX_BYTES)
+        self.uploads = {}  # Uploads into the file store, by filename (this connection's handler only)
+        self._next_legacy_write = 0.0  # monotonic() time a legacy client may get its next message
+
+    def legacy_wait(self):
+        """Seconds to wait before the next write to a legacy client (writer only)"""
+        now = time.monotonic()
+        wait = max(0.0, self._next_legacy_write - now)
+        self._next_legacy_write = now + wait + LEGACY_WRITE_GAP
+        return wait
+
+    @property
+    def framed(self):
+        return self.parser is not None
+
+    def decode(self, data):
+        """Split received bytes into messages according to the client's wire format"""
+        if self.parser is None:
+            if not is_framed(data):
+                # Legacy clients: each read is treated as exactly one message
+                return [data.decode(errors="ignore")]
+            self.parser = FrameParser()
+        self.parser.feed(data)
+        return list(self.parser.messages())
+
+    def send(self, message):
+        """Queue a str or Message using this client's wire format"""
+        if isinstance(message, str):
+            message = Message(message)
+        self.write(message.encode(self.framed, self.compressor), message.droppable)
+
+    def evict(self):
+        """Disconnect a client whose outbox overflowed"""
+        print(f"🐢 Evicting slow client {registry.username(self, self.addr)} "
+              f"({len(self.outbox)} messages / {self.outbox.bytes} bytes queued)")
+        metrics.incr("slow_consumers_evicted")
+        self.close(flush=False)
+
+    def stats(self):
+        """Outbound queue statistics for this connection"""
+        return {
+            "depth": len(self.outbox),
+            "bytes": self.outbox.bytes,
+            "high_water": self.outbox.high_water,
+            "dropped": self.outbox.dropped,
+        }
+
+    def write(self, data, droppable=False):
+        raise NotImplementedError
+
+    def close(self, flush=True):
+        """Close the connection, sending queued messages first unless flush is False"""
+        raise NotImplementedError
 
-def broadcast(message, sender_socket=None, recipient="Everyone"):
+class SocketConnection(Connection):
+    """Blocking socket used by the threaded engine, with a writer thread"""
+
+    def __init__(self, sock, addr):
+        super().__init__(addr)
+        self.sock = sock
+        self._ready = threading.Condition()
+        self._flushing = False
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def write(self, data, droppable=False):
+        with self._ready:
+            if self.closed:
+                raise ConnectionError("connection closed")
+            if self.outbox.put(data, droppable):
+                self._ready.notify()
+                return
+        self.evict()
+        raise ConnectionError("client too slow")
+
+    def _write_loop(self):
+        while True:
+            with self._ready:
+                while not self.outbox and not self.closed:
+                    self._ready.wait()
+                if self.closed and not self._flushing:
+                    return
+                batch = self.outbox.take_all()
+                finished = self.closed
+            try:
+                if batch and self.framed:
+                    # One syscall for everything that queued up meanwhile
+                    self.sock.sendall(b"".join(batch) if len(batch) > 1 else batch[0])
+                else:
+                    # Legacy clients take each recv() for one message
+                    for data in batch:
+                        time.sleep(self.legacy_wait())
+                        self.sock.sendall(data)
+            except OSError:
+                # The reader thread notices the closed socket and cleans up
+                finished = True
+            if finished:
+                self._shutdown()
+                return
+
+    def close(self, flush=True):
+        with self._ready:
+            if self.closed:
+                return
+            self.closed = True
+            # Let the writer thread send what is queued, then shut down
+            self._flushing = flush and bool(self.outbox)
+            self._ready.notify()
+        if not self._flushing:
+            self._shutdown()
+
+    def _shutdown(self):
+        try:
+            # shutdown() wakes up a writer blocked in sendall; close() alone would not
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class StreamConnection(Connection):
+    """asyncio stream used by the asyncio engine, with a writer task.
+
+    write() and close() may be called from worker threads (see
+    BLOCKING_MESSAGE_TYPES), so they hop onto the event loop when needed.
+    """
+
+    def __init__(self, reader, writer, loop):
+        super().__init__(writer.get_extra_info("peername"))
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self._ready = asyncio.Event()
+        self._writer_task = loop.create_task(self._write_loop())
+
+    def _call(self, func, *args):
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def write(self, data, droppable=False):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        self._call(self._enqueue, data, droppable)
+
+    def _enqueue(self, data, droppable):
+        if self.closed:
+            return
+        if self.outbox.put(data, droppable):
+            self._ready.set()
+        else:
+            # The read loop sees the closed stream and cleans up
+            self.evict()
+
+    async def _write_loop(self):
+        try:
+            while not self.closed:
+                if not self.outbox:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                if self.framed:
+                    self.writer.writelines(self.outbox.take_all())
+                    await self.writer.drain()
+                    continue
+                # Legacy clients take each recv() for one message
+                for data in self.outbox.take_all():
+                    await asyncio.sleep(self.legacy_wait())
+                    self.writer.write(data)
+                    await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.close(flush=False)
+
+    def _close(self, flush):
+        if flush and self.outbox:
+            # The transport still sends buffered data after close()
+            for data in self.outbox.take_all():
+                self.writer.write(data)
+        self._ready.set()
+        self.writer.close()
+
+    def close(self, flush=True):
+        if not self.closed:
+            self.closed = True
+            self._call(self._close, flush)
+
+def recipients(recipient):
+    """Connections that a message addressed to recipient should reach"""
+    if recipient == "Everyone":
+        return registry.connections()
+    if is_room(recipient):
+        return rooms.sessions(recipient)
+    return registry.sessions(recipient)
+
+def may_write(client, recipient):
+    """Rooms only take messages and files from their members"""
+    return not is_room(recipient) or client in rooms.sessions(recipient)
+
+def send_to(connections, message, skip=None):
+    """Send one Message to each connection, dropping any that fail"""
+    for c in connections:
+        if c is skip:
+            continue
+        try:
+            c.send(message)
+        except Exception:
+            c.close()
+            remove_client(c)
+
+def deliver(recipient, message, skip=None, legacy=True):
+    """Send one Message to recipient's sessions on this node and on every other node.
+
+    legacy=False leaves out clients that do not speak the framed protocol.
+    """
+    targets = recipients(recipient)
+    if not legacy:
+        targets = [c for c in targets if c.framed]
+    send_to(targets, message, skip=skip)
+    # Format: DELIVER|node|recipient|droppable|legacy, payload: the message as a framed client gets it
+    bus.publish(f"DELIVER|{NODE_ID}|{recipient}|{int(message.droppable)}|{int(legacy)}", message.encode(True))
+
+def set_typing(username, conversation, typing):
+    """Record typing on every node; each one tells its own clients"""
+    typing_aggregator.update(username, conversation, typing)
+    # Format: TYPING|node|username|conversation|0 or 1
+    bus.publish(f"TYPING|{NODE_ID}|{username}|{conversation}|{int(typing)}")
+
+def announce_in_room(room, text, skip=None):
+    """Tell a room's members about a join or leave (not stored)"""
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    deliver(room, Message(f"MSG|SERVER|{room}|{text}|{timestamp}"), skip=skip)
+
+def publish_presence(kind, seq, username):
+    """Announce one user coming online or going offline (called with presence.lock held)"""
+    # Format: PRESENCE_JOIN|seq|username or PRESENCE_LEAVE|seq|username
+    delta = Message(f"PRESENCE_{kind}|{seq}|{username}")
+    connections = registry.connections()
+    send_to([c for c in connections if c.framed], delta)
+    
+    # Legacy clients only understand the full list
+    legacy = [c for c in connections if not c.framed]
+    if legacy:
+        send_to(legacy, Message("USERS_LIST|" + "|".join(presence.snapshot()[1])))
+
+def send_presence_snapshot(client):
+    """Send one client the full list of online users"""
+    with presence.lock:
+        seq, users = presence.snapshot()
+        if client.framed:
+            # Format: PRESENCE_SNAPSHOT|seq|user1|user2|...
+            client.send(f"PRESENCE_SNAPSHOT|{seq}|" + "|".join(users))
+        else:
+            client.send("USERS_LIST|" + "|".join(users))
+
+def send_typing_update(conversation, usernames):
+    """Tell a conversation who is typing in it (one message per tick)"""
+    # Format: TYPING|user1, user2|conversation|are typing...
+    # Clients display "<usernames> <text>", and clear the indicator when both are empty
+    names = ", ".join(usernames)
+    text = "" if not usernames else "is typing..." if len(usernames) == 1 else "are typing..."
+    send_to(recipients(conversation), Message(f"TYPING|{names}|{conversation}|{text}", droppable=True))
+
+def broadcast(message, sender_socket=None, recipient="Everyone", client_id=None):
     """Send a message to all clients or a specific recipient"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    sender = clients.get(sender_socket, "SERVER")
+    now = datetime.now()
+    timestamp = now.strftime(TIMESTAMP_FORMAT)
+    sender = registry.username(sender_socket, "SERVER")
     
     # Store message in database
+    suffix = ""  # "|message id" once stored; clients page back from it (HISTORY_REQUEST|id)
     if sender != "SERVER" and message:
-        messages_collection.insert_one({
+        document = {
             "type": "message",
             "sender": sender,
             "recipient": recipient,
             "content": message,
-            "timestamp": timestamp
-        })
+            "timestamp": now
+        }
+        if client_id:
+            document["client_id"] = client_id
+        store_message(document)
+        suffix = f"|{document['_id']}"
     
-    # Format message for sending
+    # Format: MSG|sender|recipient|content|timestamp|message_id (PRIVATE likewise)
     if recipient == "Everyone":
-        formatted_msg = f"MSG|{sender}|{recipient}|{message}|{timestamp}"
+        formatted_msg = Message(f"MSG|{sender}|{recipient}|{message}|{timestamp}{suffix}")
         print(f"[Broadcast] {sender}: {message}")
-        
-        for client in clients:
-            try:
-                client.send(formatted_msg.encode())
-            except:
-                client.close()
-                remove_client(client)
+    elif is_room(recipient):
+        formatted_msg = Message(f"MSG|{sender}|{recipient}|{message}|{timestamp}{suffix}")
+        print(f"[{recipient}] {sender}: {message}")
     else:
         # Private message
-        formatted_msg = f"PRIVATE|{sender}|{recipient}|{message}|{timestamp}"
+        formatted_msg = Message(f"PRIVATE|{sender}|{recipient}|{message}|{timestamp}{suffix}")
         print(f"[Private] {sender} to {recipient}: {message}")
+    
+    deliver(recipient, formatted_msg)
+
+def remove_client(client):
+    """Remove a client's session; announce the user's departure with their last session"""
+    # Unfinished uploads keep their bytes in the store for a resume
+    file_store.abandon(client)
+    rooms.leave_all(client)
+    
+    # Under presence.lock so the deltas match the order of logins and logouts
+    went_offline = False
+    with presence.lock:
+        username, last_session = registry.remove(client)
+        if last_session:
+            went_offline = nodes.remove(NODE_ID, username)
+            if went_offline:
+                presence.leave(username)
+            # Format: OFFLINE|node|username (no sessions left on that node)
+            bus.publish(f"OFFLINE|{NODE_ID}|{username}")
+    if last_session:
+        print(f"❌ {username} disconnected.")
+    if went_offline:
+        typing_aggregator.forget(username)
+        broadcast(f"{username} left the chat.")
+
+def announce_node():
+    """Introduce this node on the bus (at startup and after reconnecting to it)"""
+    # Format: SYNC|node asks every other node to repeat its ONLINE list
+    bus.publish(f"SYNC|{NODE_ID}")
+    with presence.lock:
+        local_users = nodes.users_on(NODE_ID)
+    if local_users:
+        bus.publish(f"ONLINE|{NODE_ID}|" + "|".join(local_users))
+
+def handle_bus_message(message):
+    """Apply one message published by another node"""
+    parts = message.header.split("|")
+    kind, origin = parts[0], parts[1]
+    if origin == NODE_ID:
+        return
+    if kind == "NODE_DOWN":
+        drop_node(origin)
+        return
+    with presence.lock:
+        nodes.seen(origin)
+    
+    if kind == "DELIVER":
+        recipient, droppable, legacy = parts[2], parts[3] == "1", parts[4] == "1"
+        parser = FrameParser()
+        parser.feed(message.data)
+        for relayed in parser.messages():
+            outgoing = BinaryRelay(relayed) if isinstance(relayed, BinaryMessage) else Message(relayed, droppable)
+            targets = recipients(recipient)
+            send_to(targets if legacy else [c for c in targets if c.framed], outgoing)
+    
+    elif kind == "STORED":
+        # Keep this node's history cache and search index complete
+        document = json_util.loads(bytes(message.data))
+        if "client_id" in document:
+            recent_ids.add(document["sender"], document["client_id"])
+        history_cache.add(document)
+        search_index.add(document)
+        if "sha256" in document:
+            file_shares.add(document)
+    
+    elif kind == "TYPING":
+        typing_aggregator.update(parts[2], parts[3], parts[4] == "1")
+    
+    elif kind == "ONLINE":
+        with presence.lock:
+            for username in parts[2:]:
+                if username and nodes.add(origin, username):
+                    presence.join(username)
+    
+    elif kind == "OFFLINE":
+        with presence.lock:
+            went_offline = nodes.remove(origin, parts[2])
+            if went_offline:
+                presence.leave(parts[2])
+        if went_offline:
+            typing_aggregator.forget(parts[2])
+    
+    elif kind == "SYNC":
+        with presence.lock:
+            local_users = nodes.users_on(NODE_ID)
+        if local_users:
+            bus.publish(f"ONLINE|{NODE_ID}|" + "|".join(local_users))
+
+def drop_node(node):
+    """Take the users of a dead node offline, unless they are on another node too"""
+    with presence.lock:
+        gone = nodes.drop_node(node)
+        for username in gone:
+            presence.leave(username)
+    if gone:
+        print(f"🛑 Node {node} is gone; {len(gone)} users went offline")
+        metrics.incr("nodes_lost")
+    timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    for username in gone:
+        typing_aggregator.forget(username)
+        # Every node announces this to its own clients
+        send_to(registry.connections(), Message(f"MSG|SERVER|Everyone|{username} left the chat.|{timestamp}"))
+
+def expire_partials():
+    """Delete unfinished uploads that nobody has resumed for PARTIAL_TTL"""
+    while True:
+        time.sleep(PARTIAL_SWEEP_INTERVAL)
+        removed = file_store.expire()
+        if removed:
+            print(f"🧹 Deleted {removed} expired partial upload(s)")
+
+def run_heartbeat():
+    """Tell the other nodes we are alive and drop the ones that went silent"""
+    while True:
+        time.sleep(NODE_HEARTBEAT)
+        bus.publish(f"HEARTBEAT|{NODE_ID}")
+        with presence.lock:
+            silent = nodes.silent(NODE_TIMEOUT)
+        for node in silent:
+            drop_node(node)
+
+def publish_file(client, transfer):
+    """Record a file that is complete in the store and offer it to its recipients"""
+    sender = transfer["sender"]
+    recipient = transfer["recipient"]
+    filename = transfer["filename"]
+    filesize = transfer["filesize"]
+    digest = transfer["sha256"]
+    print(f"[File] {sender} shared {filename} ({filesize//1024}KB) with {recipient}, stored as {digest[:12]}")
+    
+    store_message({
+        "type": "file",
+        "sender": sender,
+        "recipient": recipient,
+        "filename": filename,
+        "filesize": str(filesize),
+        "sha256": digest,
+        "timestamp": parse_timestamp(transfer["timestamp"])
+    })
+    
+    # Framed clients fetch the file themselves; legacy ones get it pushed
+    # (only on this node, which has the file)
+    available = Message(f"FILE_AVAILABLE|{sender}|{recipient}|{filename}|{filesize}|{transfer['timestamp']}|{digest}")
+    deliver(recipient, available, skip=client, legacy=False)
+    for c in recipients(recipient):
+        if not c.framed and c is not client:
+            threading.Thread(target=push_file_legacy, args=(c, transfer), daemon=True).start()
+
+def push_file_legacy(conn, transfer):
+    """Send a stored file to a legacy client as base64 FILE_CHUNKs, at the client's pace"""
+    sender = transfer["sender"]
+    recipient = transfer["recipient"]
+    filename = transfer["filename"]
+    filesize = transfer["filesize"]
+    header = f"{sender}|{recipient}|{filename}"
+    total_chunks = -(-filesize // LEGACY_FILE_CHUNK)
+    try:
+        conn.send(f"FILE_INFO|{header}|{-(-filesize // 3) * 4}|{transfer['timestamp']}")
+        with open(file_store.path(transfer["sha256"]), "rb") as f:
+            for chunk_num in range(total_chunks):
+                # Only keep a little of the file queued for this client at a time
+                while conn.outbox.bytes > OUTBOX_MAX_BYTES // 2 and not conn.closed:
+                    time.sleep(0.05)
+                chunk = base64.b64encode(f.read(LEGACY_FILE_CHUNK)).decode()
+                conn.send(f"FILE_CHUNK|{header}|{chunk_num}|{total_chunks}|{chunk}")
+        conn.send(f"FILE_COMPLETE|{header}|{transfer['timestamp']}")
+    except (ConnectionError, OSError):
+        pass  # Disconnected; its reader cleans up
+
+def handle_message(client, username, message):
+    """Handle one message from a client.
+
+    Returns False when the client has logged out.
+    """
+    if isinstance(message, BinaryMessage):
+        # Binary frames carry file chunks; only their header is parsed
+        parts = message.header.split("|")
+        outgoing = BinaryRelay(message)
+        metrics.incr("file_bytes_relayed", len(message.frame))
+    else:
+        parts = message.split("|")
+        outgoing = Message(message)  # Relayed as-is by the FILE_* branches
+    msg_type = parts[0]
+    
+    if msg_type == "TYPING":
+        # Format: TYPING|sender|recipient|typing_text
+        # An empty typing_text means the sender stopped typing; sender is
+        # ignored, typing is always recorded for the logged-in user
+        recipient = parts[2]
+        typing_text = parts[3]
+        if not may_write(client, recipient):
+            return True  # Sent on every keystroke, so no ERROR; stale typists expire anyway
+        
+        # Recipients get one combined update per tick from typing_aggregator
+        set_typing(username, recipient, bool(typing_text))
+    
+    elif msg_type == "COMPRESS":
+        # Format: COMPRESS|codec1,codec2,... (the codecs the client supports)
+        # Reply:  COMPRESS|codec used for large frames from now on, or COMPRESS| for none
+        offered = parts[1].split(",") if len(parts) > 1 else []
+        codec = next((codec for codec in compressors if codec in offered), None)
+        client.compressor = compressors.get(codec)
+        client.send(f"COMPRESS|{codec or ''}")
+    
+    elif msg_type == "PRESENCE_SYNC":
+        # Format: PRESENCE_SYNC (the client missed a delta)
+        metrics.incr("presence_resyncs")
+        send_presence_snapshot(client)
+    
+    elif msg_type in ("MSG", "PRIVATE"):
+        # Format: MSG|sender|recipient|content|timestamp|message_id
+        #     or: PRIVATE|sender|recipient|content|timestamp|message_id
+        # Reply:  MSG_ACK|message_id once the message has been accepted
+        # message_id is chosen by the client, which resends unacknowledged
+        # messages after a reconnect; older clients leave it out
+        recipient = parts[2]
+        content = parts[3]
+        timestamp = parts[4] if len(parts) > 4 else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        client_id = parts[5] if len(parts) > 5 else None
+        
+        if not may_write(client, recipient):
+            client.send(f"ERROR|Join {recipient} before writing to it")
+        elif client_id and not recent_ids.add(username, client_id):
+            metrics.incr("duplicates_dropped")  # A resend of a message we already have
+        else:
+            set_typing(username, recipient, False)  # Sending a message ends typing
+            try:
+                broadcast(content, client, recipient, client_id)
+            except Exception:
+                if client_id:
+                    recent_ids.discard(username, client_id)  # Not stored, so a resend must get through
+                raise
+        if client_id:
+            client.send(f"MSG_ACK|{client_id}")
+    
+    elif msg_type == "FILE_INFO":
+        # Format: FILE_INFO|sender|recipient|filename|filesize|timestamp
+        sender = parts[1]
+        recipient = parts[2]
+        filename = parts[3]
+        filesize = parts[4]
+        timestamp = parts[5]
+        if not may_write(client, recipient):
+            client.send(f"ERROR|Join {recipient} before writing to it")
+            return True
+        
+        # Add this line to log file transfers in the server console
+        print(f"[File] {sender} is sending {filename} ({int(filesize)//1024}KB) to {recipient}")
+        
+        # Store file info in database
+        store_message({
+            "type": "file",
+            "sender": sender,
+            "recipient": recipient,
+            "filename": filename,
+            "filesize": filesize,
+            "timestamp": parse_timestamp(timestamp)
+        })
         
-        # Find recipient socket
-        recipient_socket = None
-        for client, username in clients.items():
-            if username == recipient:
-                recipient_socket = client
-                break
+        # Forward file info to recipient(s)
+        deliver(recipient, outgoing)
+    
+    elif msg_type == "FILE_OFFER":
+        # Format: FILE_OFFER|sender|recipient|filename|filesize|timestamp|sha256
+        # Reply:  FILE_RESUME|filename|offset (offset == filesize: already stored)
+        filename = parts[3]
+        if not may_write(client, parts[2]):
+            client.send(f"FILE_FAILED|{filename}|Join {parts[2]} before sending files to it")
+            return True
+        try:
+            transfer = {
+                "sender": username,  # The file record grants access, so it names who really sent it
+                "recipient": parts[2],
+                "filename": filename,
+                "filesize": int(parts[4]),
+                "timestamp": parts[5],
+                "sha256": parts[6]
+            }
+            # Only someone the file was shared with may skip uploading it;
+            # anyone else proves they have it by sending it anyway
+            known = may_fetch(client, username, transfer["sha256"])
+            offset = file_store.offer(transfer["sha256"], transfer["filesize"], client, username, reupload=not known)
+        except (StoreError, ValueError, IndexError, OSError) as e:
+            client.send(f"FILE_FAILED|{filename}|{e}")
+            return True
         
-        if recipient_socket:
+        client.send(f"FILE_RESUME|{filename}|{offset}")
+        if offset == transfer["filesize"]:
+            publish_file(client, transfer)  # Nothing to upload
+        else:
+            client.uploads[filename] = transfer
+    
+    elif msg_type == "FILE_CHUNK":
+        sender = parts[1]
+        recipient = parts[2]
+        filename = parts[3]
+        if not may_write(client, recipient):
+            if isinstance(message, BinaryMessage):
+                client.uploads.pop(filename, None)
+                client.send(f"FILE_FAILED|{filename}|Join {recipient} before sending files to it")
+            return True  # Legacy senders get told once, by their FILE_INFO
+        
+        transfer = client.uploads.get(filename) if isinstance(message, BinaryMessage) else None
+        if transfer is not None:
+            # Format: FILE_CHUNK|sender|recipient|filename|chunk_num|total_chunks|offset
+            # Upload into the file store; recipients fetch the file once it is complete
             try:
-                recipient_socket.send(formatted_msg.encode())
-            except:
-                recipient_socket.close()
-                remove_client(recipient_socket)
+                complete = file_store.write(transfer["sha256"], client, int(parts[6]), message.data)
+            except (StoreError, ValueError, IndexError, OSError) as e:
+                client.uploads.pop(filename, None)
+                client.send(f"FILE_FAILED|{filename}|{e}")
+                return True
+            client.send(f"FILE_ACK|{filename}|{parts[4]}")
+            if complete:
+                publish_file(client, client.uploads.pop(filename))
+        elif not client.framed:
+            # Forward legacy base64 chunks to recipient(s)
+            deliver(recipient, outgoing)
+        # Framed clients upload through FILE_OFFER; chunks with no upload
+        # are the rest of a window that was in flight when it failed
+    
+    elif msg_type == "FILE_FETCH":
+        # Format: FILE_FETCH|sha256|offset|length
+        # Reply:  binary FILE_DATA|sha256|offset frames covering the range
+        digest = parts[1]
+        size = file_store.size(digest)
+        if size is None or not client.framed or not may_fetch(client, username, digest):
+            client.send(f"FILE_FAILED|{digest}|file not found")  # Same answer either way, so digests cannot be probed
+            return True
+        try:
+            offset = int(parts[2])
+            length = int(parts[3])
+        except (ValueError, IndexError):
+            client.send(f"FILE_FAILED|{digest}|invalid range")
+            return True
+        if not 0 <= offset <= size or length < 0:
+            client.send(f"FILE_FAILED|{digest}|invalid range")
+            return True
+        end = min(offset + min(length, FILE_FETCH_MAX), size)
+        while offset < end:
+            data = file_store.read(digest, offset, min(FILE_DATA_CHUNK, end - offset))
+            client.write(encode_binary_frame(f"FILE_DATA|{digest}|{offset}", data, client.compressor))
+            metrics.incr("file_store_bytes_served", len(data))
+            offset += len(data)
+    
+    elif msg_type == "FILE_COMPLETE":
+        # Forward file chunks to recipient(s)
+        sender = parts[1]
+        recipient = parts[2]
+        filename = parts[3]
+        if not may_write(client, recipient):
+            return True
+        
+        # Add this line to log completed file transfers
+        print(f"[File] Transfer complete: {filename} from {sender} to {recipient}")
+        
+        deliver(recipient, outgoing)
+    
+    elif msg_type == "HISTORY_REQUEST":
+        # Format: HISTORY_REQUEST               -> HISTORY|json (latest messages)
+        #         HISTORY_REQUEST|before_id     -> HISTORY_PAGE|before_id|json
+        # The json arrays are split over as many frames as needed, oldest first
+        if len(parts) > 1 and parts[1]:
+            try:
+                before_id = ObjectId(parts[1])
+            except (InvalidId, TypeError):
+                client.send("ERROR|Invalid history cursor")
+                return True
+            page = load_history_page(username, before_id)
+            history_msgs = (f"HISTORY_PAGE|{parts[1]}|{array}" for array in json_arrays(map(to_json, page)))
+        else:
+            # Send the latest messages, served from the history cache
+            history_msgs = history_cache.history(username, load_private_history)
+        
+        try:
+            for history_msg in history_msgs:
+                client.send(history_msg)
+        except:
+            client.close()
+            remove_client(client)
+    
+    elif msg_type == "SEARCH":
+        # Format: SEARCH|search_term
+        search_term = parts[1]
+        
+        # Format: SEARCH|search_term|#room searches only that room
+        joined = rooms.rooms_of(client)
+        room = parts[2] if len(parts) > 2 and parts[2] in joined else None
+        
+        # Search the in-memory index; MongoDB is only asked about older messages
+        results = search_index.search(
+            username, search_term, functools.partial(search_archive, joined=joined, room=room), joined, room)
+        
+        try:
+            # Format: SEARCH_RESULTS|json, in as many frames as needed
+            for results_json in results:
+                client.send(f"SEARCH_RESULTS|{results_json}")
+        except:
+            client.close()
+            remove_client(client)
+    
+    elif msg_type == "ROOM_JOIN":
+        # Format: ROOM_JOIN|#room, or ROOM_JOIN|#room|rejoin after a reconnect
+        # Reply:  ROOM_JOINED|#room|member1|member2|... then ROOM_HISTORY|#room|json
+        #         (in as many frames as needed; none for a rejoin)
+        room = parts[1]
+        if not ROOM_NAME.fullmatch(room):
+            client.send(f"ERROR|Invalid room name {room}")
+        else:
+            if rooms.join(room, client):
+                announce_in_room(room, f"{username} joined {room}.", skip=client)
+            members = sorted({registry.username(c) for c in rooms.sessions(room)} - {None})
+            client.send(f"ROOM_JOINED|{room}|" + "|".join(members))
+            if len(parts) < 3 or parts[2] != "rejoin":
+                for history_json in history_cache.room(room, load_room_history):
+                    client.send(f"ROOM_HISTORY|{room}|{history_json}")
+    
+    elif msg_type == "ROOM_LEAVE":
+        # Format: ROOM_LEAVE|#room
+        room = parts[1]
+        if rooms.leave(room, client):
+            announce_in_room(room, f"{username} left {room}.")
+        client.send(f"ROOM_LEFT|{room}")
+    
+    elif msg_type == "ROOMS":
+        # Format: ROOMS; reply: ROOMS|#room1|#room2|... (rooms with members)
+        client.send("ROOMS|" + "|".join(rooms.active_rooms()))
+    
+    elif msg_type == "LOGOUT":
+        return False
+    
+    else:
+        print(f"[Unknown message type] {msg_type}")
 
-def remove_client(client):
-    """Remove a client from the clients dictionary"""
-    if client in clients:
-        username = clients[client]
-        del clients[client]
-        broadcast(f"{username} left the chat.")
-        print(f"❌ {username} disconnected.")
-        broadcast_users_list()
+    return True
 
-def handle_client(client, username):
-    """Handle messages from a client"""
+def handle_client(client, username, pending=()):
+    """Handle messages from a client (threaded engine)"""
+    messages = list(pending)
     while True:
         try:
-            message = client.recv(65536).decode(errors="ignore")
-            if not message:
-                break
-            
-            parts = message.split("|")
-            msg_type = parts[0]
-            
-            if msg_type == "TYPING":
-                # Format: TYPING|sender|recipient|typing_text
-                sender = parts[1]
-                recipient = parts[2]
-                typing_text = parts[3]
-                
-                typing_msg = f"TYPING|{sender}|{recipient}|{typing_text}"
-                
-                if recipient == "Everyone":
-                    # Send to everyone except sender
-                    for c in clients:
-                        if c != client:
-                            try:
-                                c.send(typing_msg.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-                else:
-                    # Send to specific recipient
-                    for c, name in clients.items():
-                        if name == recipient:
-                            try:
-                                c.send(typing_msg.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-            
-            elif msg_type == "MSG":
-                # Format: MSG|sender|recipient|content|timestamp
-                sender = parts[1]
-                recipient = parts[2]
-                content = parts[3]
-                timestamp = parts[4] if len(parts) > 4 else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                
-                broadcast(content, client, recipient)
-            
-            elif msg_type == "PRIVATE":
-                # Format: PRIVATE|sender|recipient|content|timestamp
-                sender = parts[1]
-                recipient = parts[2]
-                content = parts[3]
-                timestamp = parts[4] if len(parts) > 4 else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                
-                broadcast(content, client, recipient)
-            
-            elif msg_type == "FILE_INFO":
-                # Format: FILE_INFO|sender|recipient|filename|filesize|timestamp
-                sender = parts[1]
-                recipient = parts[2]
-                filename = parts[3]
-                filesize = parts[4]
-                timestamp = parts[5]
-                
-                # Add this line to log file transfers in the server console
-                print(f"[File] {sender} is sending {filename} ({int(filesize)//1024}KB) to {recipient}")
-                
-                # Store file info in database
-                messages_collection.insert_one({
-                    "type": "file",
-                    "sender": sender,
-                    "recipient": recipient,
-                    "filename": filename,
-                    "filesize": filesize,
-                    "timestamp": timestamp
-                })
-                
-                # Forward file info to recipient(s)
-                if recipient == "Everyone":
-                    for c in clients:
-                            try:
-                                c.send(message.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-                else:
-                    for c, name in clients.items():
-                        if name == recipient:
-                            try:
-                                c.send(message.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-            
-            elif msg_type == "FILE_CHUNK":
-                # Forward file chunks to recipient(s)
-                sender = parts[1]
-                recipient = parts[2]
-                
-                if recipient == "Everyone":
-                    for c in clients:
-                            try:
-                                c.send(message.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-                else:
-                    for c, name in clients.items():
-                        if name == recipient:
-                            try:
-                                c.send(message.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-            
-            elif msg_type == "FILE_COMPLETE":
-                # Forward file chunks to recipient(s)
-                sender = parts[1]
-                recipient = parts[2]
-                filename = parts[3]
-                
-                # Add this line to log completed file transfers
-                print(f"[File] Transfer complete: {filename} from {sender} to {recipient}")
-                
-                if recipient == "Everyone":
-                    for c in clients:
-                            try:
-                                c.send(message.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-                else:
-                    for c, name in clients.items():
-                        if name == recipient:
-                            try:
-                                c.send(message.encode())
-                            except:
-                                c.close()
-                                remove_client(c)
-            
-            elif msg_type == "HISTORY_REQUEST":
-                # Send message history to client
-                history = list(messages_collection.find(
-                    {"$or": [
-                        {"recipient": "Everyone"},
-                        {"recipient": username},
-                        {"sender": username}
-                    ]}
-                ).sort("timestamp", 1).limit(50))
-                
-                # Convert ObjectId to string for JSON serialization
-                for msg in history:
-                    msg["_id"] = str(msg["_id"])
-                
-                history_json = json.dumps(history)
-                history_msg = f"HISTORY|{history_json}"
-                
-                try:
-                    client.send(history_msg.encode())
-                except:
-                    client.close()
-                    remove_client(client)
-            
-            elif msg_type == "SEARCH":
-                # Format: SEARCH|search_term
-                search_term = parts[1]
-                
-                # Search messages in database
-                results = list(messages_collection.find(
-                    {"$text": {"$search": search_term},
-                     "$or": [
-                         {"recipient": "Everyone"},
-                         {"recipient": username},
-                         {"sender": username}
-                     ]}
-                ).sort("timestamp", -1).limit(20))
-                
-                # Convert ObjectId to string for JSON serialization
-                for msg in results:
-                    msg["_id"] = str(msg["_id"])
-                
-                results_json = json.dumps(results)
-                results_msg = f"SEARCH_RESULTS|{results_json}"
-                
-                try:
-                    client.send(results_msg.encode())
-                except:
-                    client.close()
-                    remove_client(client)
-            
-            elif msg_type == "LOGOUT":
-                break
-            
+            for message in messages:
+                if not handle_message(client, username, message):
+                    break
             else:
-                print(f"[Unknown message type] {msg_type}")
-        
+                data = client.recv(65536)
+                if not data:
+                    break
+                messages = client.decode(data)
+                continue
+            break
+
         except Exception as e:
             print(f"[Error handling client] {str(e)}")
             break
-    
+
     # Client disconnected
     client.close()
     remove_client(client)
 
-def authenticate(client):
-    """Authenticate a user"""
+def receive_login(client):
+    """Read the login message, detecting the client's wire format on the way.
+
+    Returns (login_data, pipelined_messages), or (None, []) if the client
+    hung up first.
+    """
+    messages = []
+    while not messages:
+        data = client.recv(1024)
+        if not data:
+            return None, []
+        messages = client.decode(data)
+    return messages[0], messages[1:]
+
+def authenticate(client, data):
+    """Authenticate a user from their login message.
+
+    Format: username||password, or TOKEN|username|session_token with the
+    token from an earlier login, which skips bcrypt.
+    """
     try:
-        data = client.recv(1024).decode()
+        if data.startswith("TOKEN|"):
+            _, username, token = data.split("|", 2)
+            if not token_signer.verify(username, token):
+                metrics.incr("login_token_rejected")
+                client.send("LOGIN_FAILED")  # The client falls back to its password
+                return None
+            metrics.incr("login_token")
+            client.send("LOGIN_SUCCESS")
+            send_session_token(client, username)
+            return username
+        
         username, password = data.split("||")
+        if username.startswith(ROOM_PREFIX):
+            client.send("LOGIN_FAILED")  # Would be taken for a room name
+            return None
+        address = client.addr[0] if isinstance(client.addr, tuple) else client.addr
+        per_ip = throttles(address)
+        if (per_ip and not ip_logins.allow(address)) or not user_logins.allow(username):
+            metrics.incr("login_throttled")
+            client.send("LOGIN_THROTTLED")
+            return None
         user = users_collection.find_one({"username": username})
 
         if user:
             # Check if password matches
-            stored_password = user['password']
-            # Handle both string and bytes format for stored password
-            if isinstance(stored_password, str):
-                password_match = bcrypt.checkpw(password.encode(), stored_password.encode())
-            else:
-                password_match = bcrypt.checkpw(password.encode(), stored_password)
+            with metrics.timer("bcrypt_check"):
+                password_match = password_pool.submit(check_password, password, user['password']).result()
                 
             if password_match:
-                client.send("LOGIN_SUCCESS".encode())
+                client.send("LOGIN_SUCCESS")
+                send_session_token(client, username)
                 return username
             else:
-                client.send("LOGIN_FAILED".encode())
+                metrics.incr("login_failed")
+                client.send("LOGIN_FAILED")
                 return None
         else:
+            if per_ip and not ip_signups.allow(address):
+                metrics.incr("signup_throttled")
+                client.send("LOGIN_THROTTLED")
+                return None
             # Create new user
-            hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+            with metrics.timer("bcrypt_hash"):
+                hashed_pw = password_pool.submit(hash_password, password).result()
             users_collection.insert_one({
                 "username": username, 
-                "password": hashed_pw.decode(),
+                "password": hashed_pw,
                 "created_at": datetime.now()
             })
-            client.send("SIGNUP_SUCCESS".encode())
+            client.send("SIGNUP_SUCCESS")
+            send_session_token(client, username)
             return username
     except Exception as e:
         print(f"[ERROR] Auth: {str(e)}")
-        client.send("ERROR".encode())
+        client.send("ERROR")
         return None
 
-def receive_connections():
-    """Accept new client connections"""
+def send_session_token(client, username):
+    """Give a framed client a token to log in with next time"""
+    if client.framed:
+        # Format: SESSION_TOKEN|token
+        client.send(f"SESSION_TOKEN|{token_signer.issue(username)}")
+
+def register_client(client, username):
+    """Add an authenticated client and announce it to everyone"""
+    # Send welcome message (raises if the client is already gone)
+    client.send("WELCOME")
+    
+    # Add client to the registry; everyone else only gets a JOIN delta
+    came_online = False
+    with presence.lock:
+        first_session = registry.add(client, username)
+        if first_session:
+            came_online = nodes.add(NODE_ID, username)
+            if came_online:
+                presence.join(username)
+            # Format: ONLINE|node|username|... (users with sessions on that node)
+            bus.publish(f"ONLINE|{NODE_ID}|{username}")
+    
+    if came_online:
+        # Broadcast new user joined
+        broadcast(f"✅ {username} joined the chat.")
+    
+    # The new session gets the whole list once
+    send_presence_snapshot(client)
+
+def create_server_socket():
+    """Create the listening socket for the threaded engine.
+
+    The socket is not wrapped with TLS; each connection does its own
+    handshake in login_connection so a slow client cannot hold up accept().
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((HOST, PORT))
+    server.listen(MAX_PENDING_AUTH)
+    return server
+
+def login_connection(auth_pool, sock, addr, auth_slots, accepted_at):
+    """TLS handshake for one connection, then its login once it arrives (runs in the auth pool)"""
+    metrics.observe("auth_queue_wait", time.perf_counter() - accepted_at)
+    try:
+        # Bound the time a silent client can hold this worker
+        sock.settimeout(LOGIN_TIMEOUT)
+        if ssl_context:
+            started = time.perf_counter()
+            sock = ssl_context.wrap_socket(sock, server_side=True)
+            record_handshake(sock, time.perf_counter() - started)
+    except OSError as e:
+        print(f"[ERROR] Login from {addr}: {e}")
+        metrics.incr("login_errors")
+        sock.close()
+        end_login(auth_slots, accepted_at)
+        return
+    
+    client = SocketConnection(sock, addr)
+    if isinstance(sock, ssl.SSLSocket) and sock.pending():
+        finish_login(client, auth_slots, accepted_at)  # The login is already decrypted
+        return
+    # Clients connect before their user has typed a password; wait for the
+    # login without holding this worker, within the same LOGIN_TIMEOUT
+    login_waiter.park(sock, accepted_at + LOGIN_TIMEOUT,
+                      lambda: auth_pool.submit(finish_login, client, auth_slots, accepted_at),
+                      lambda: expire_login(client, auth_slots, accepted_at))
+
+def expire_login(client, auth_slots, accepted_at):
+    """Drop a connection that never sent its login"""
+    print(f"[ERROR] Login from {client.addr}: timed out")
+    metrics.incr("login_errors")
+    client.close()
+    end_login(auth_slots, accepted_at)
+
+def end_login(auth_slots, accepted_at):
+    """Free the connection's place among the logins in flight"""
+    auth_slots.release()
+    metrics.add_gauge("auth_pending", -1)
+    metrics.observe("auth_latency", time.perf_counter() - accepted_at)
+
+def finish_login(client, auth_slots, accepted_at):
+    """Read and check the login of a connection whose first bytes arrived (runs in the auth pool)"""
+    username = None
+    pending = []
+    try:
+        data, pending = receive_login(client)
+        username = authenticate(client, data) if data else None
+        client.sock.settimeout(None)
+    except OSError as e:
+        print(f"[ERROR] Login from {client.addr}: {e}")
+        metrics.incr("login_errors")
+    finally:
+        end_login(auth_slots, accepted_at)
+
+    if username:
+        try:
+            register_client(client, username)
+        except Exception as e:
+            print(f"[ERROR] Register {username}: {str(e)}")
+            client.close()
+            remove_client(client)
+            return
+        
+        # Start thread to handle client messages
+        thread = threading.Thread(target=handle_client, args=(client, username, pending))
+        thread.daemon = True
+        thread.start()
+    else:
+        client.close()
+
+def receive_connections(server):
+    """Accept new client connections and hand them to the auth pool"""
+    auth_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+    threading.Thread(target=login_waiter.run, name="login-waiter", daemon=True).start()
+    auth_slots = threading.BoundedSemaphore(MAX_PENDING_AUTH)
     while True:
-        client, addr = server.accept()
+        sock, addr = server.accept()
         print(f"🔌 Connection from {addr}")
 
-        username = authenticate(client)
-        if username:
-            # Add client to clients dictionary
-            clients[client] = username
-            
-            # Send welcome message
-            client.send("WELCOME".encode())
-            
-            # Broadcast new user joined
-            broadcast(f"✅ {username} joined the chat.")
-            
-            # Update users list for all clients
-            broadcast_users_list()
-            
-            # Start thread to handle client messages
-            thread = threading.Thread(target=handle_client, args=(client, username))
-            thread.daemon = True
-            thread.start()
-        else:
-            client.close()
+        # Once MAX_PENDING_AUTH logins are in flight, stop accepting and let
+        # new clients wait in the kernel's listen backlog
+        auth_slots.acquire()
+        metrics.add_gauge("auth_pending", 1)
+        auth_pool.submit(login_connection, auth_pool, sock, addr, auth_slots, time.perf_counter())
+
+async def receive_stream_login(client):
+    """asyncio counterpart of receive_login"""
+    messages = []
+    while not messages:
+        data = await client.reader.read(1024)
+        if not data:
+            return None, []
+        messages = client.decode(data)
+    return messages[0], messages[1:]
+
+async def login_stream(client, auth_slots):
+    """Login for one stream; returns (username, pipelined_messages)"""
+    loop = asyncio.get_running_loop()
+    accepted_at = time.perf_counter()
+    metrics.add_gauge("auth_pending", 1)
+    try:
+        async with auth_slots:
+            metrics.observe("auth_queue_wait", time.perf_counter() - accepted_at)
+            data, pending = await asyncio.wait_for(receive_stream_login(client), LOGIN_TIMEOUT)
+            if not data:
+                return None, []
+            username = await loop.run_in_executor(None, authenticate, client, data)
+            return username, pending
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"[ERROR] Login from {client.addr}: {e!r}")
+        metrics.incr("login_errors")
+        return None, []
+    finally:
+        metrics.add_gauge("auth_pending", -1)
+        metrics.observe("auth_latency", time.perf_counter() - accepted_at)
+
+async def handle_stream(reader, writer, auth_slots):
+    """Serve one client connection (asyncio engine)"""
+    loop = asyncio.get_running_loop()
+    if ssl_context:
+        # The server finished the handshake before calling us, so it is
+        # counted but not timed here
+        record_handshake(writer.get_extra_info("ssl_object"))
+    client = StreamConnection(reader, writer, loop)
+    print(f"🔌 Connection from {client.addr}")
+
+    username, messages = await login_stream(client, auth_slots)
+    if not username:
+        client.close()
+        return
+
+    try:
+        register_client(client, username)
+    except Exception as e:
+        print(f"[ERROR] Register {username}: {str(e)}")
+        client.close()
+        remove_client(client)
+        return
+
+    while True:
+        try:
+            for message in messages:
+                text = message.header if isinstance(message, BinaryMessage) else message
+                msg_type = text.split("|", 1)[0]
+                if msg_type in BLOCKING_MESSAGE_TYPES or (
+                        msg_type in PERSISTED_MESSAGE_TYPES and message_writer.blocking):
+                    keep_going = await loop.run_in_executor(None, handle_message, client, username, message)
+                else:
+                    keep_going = handle_message(client, username, message)
+                if not keep_going:
+                    break
+            else:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                messages = client.decode(data)
+                continue
+            break
+
+        except Exception as e:
+            print(f"[Error handling client] {str(e)}")
+            break
+
+    # Client disconnected
+    client.close()
+    remove_client(client)
+
+async def serve_asyncio():
+    """Run the asyncio engine until cancelled"""
+    # The event loop already runs TLS handshakes concurrently; auth_slots
+    # bounds how many logins may then be in flight at once
+    auth_slots = asyncio.Semaphore(MAX_PENDING_AUTH)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_stream(reader, writer, auth_slots),
+        HOST, PORT, ssl=ssl_context, backlog=MAX_PENDING_AUTH,
+        ssl_handshake_timeout=LOGIN_TIMEOUT if ssl_context else None)
+    print(f"✅ Server started on {HOST}:{PORT} (asyncio engine)")
+    async with server:
+        await server.serve_forever()
+
+def run_threaded():
+    """Run the threaded engine until interrupted"""
+    server = create_server_socket()
+    print(f"✅ Server started on {HOST}:{PORT} (threaded engine)")
+    try:
+        receive_connections(server)
+    finally:
+        server.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CryptoChat server")
+    parser.add_argument("--mode", choices=SERVER_MODES, default=SERVER_MODE,
+                        help="server engine to run (default: %(default)s)")
+    parser.add_argument("--max-pending-auth", type=int, default=MAX_PENDING_AUTH,
+                        help="connections allowed to handshake/authenticate at once (default: %(default)s)")
+    parser.add_argument("--hash-workers", type=int, default=HASH_WORKERS,
+                        help="processes used for bcrypt (default: %(default)s)")
+    parser.add_argument("--persist-mode", choices=PERSIST_MODES, default=PERSIST_MODE,
+                        help="how messages are written to MongoDB (default: %(default)s)")
+    parser.add_argument("--typing-tick", type=float, default=TYPING_TICK,
+                        help="seconds between combined typing updates (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="port to listen on (default: %(default)s)")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=COMPRESS_LEVEL,
+                        help="compression level for large frames, 1 (fastest) to 9 (smallest); "
+                             "0 disables compression (default: %(default)s)")
+    parser.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD,
+                        help="smallest frame payload worth compressing, in bytes (default: %(default)s)")
+    parser.add_argument("--login-rate-per-ip", type=parse_rate, default=LOGIN_RATE_PER_IP, metavar="RATE,BURST",
+                        help="password logins per second and burst, per IP address (default: 0.5,10)")
+    parser.add_argument("--login-rate-per-user", type=parse_rate, default=LOGIN_RATE_PER_USER, metavar="RATE,BURST",
+                        help="password logins per second and burst, per username (default: 0.2,5)")
+    parser.add_argument("--signup-rate-per-ip", type=parse_rate, default=SIGNUP_RATE_PER_IP, metavar="RATE,BURST",
+                        help="new accounts per second and burst, per IP address (default: 1/60,3)")
+    parser.add_argument("--throttle-loopback", action="store_true",
+                        help="apply the per-IP limits to loopback clients too (off by default)")
+    parser.add_argument("--bus", default=BUS_ADDRESS,
+                        help="message bus shared with other nodes: local://, tcp://host:port "
+                             "or unix:///path (default: %(default)s)")
+    args = parser.parse_args()
+    PORT = args.port
+    BUS_ADDRESS = args.bus
+    MAX_PENDING_AUTH = args.max_pending_auth
+    HASH_WORKERS = args.hash_workers
+    PERSIST_MODE = args.persist_mode
+    THROTTLE_LOOPBACK = args.throttle_loopback
+    ip_logins = RateLimiter(*args.login_rate_per_ip)
+    user_logins = RateLimiter(*args.login_rate_per_user)
+    ip_signups = RateLimiter(*args.signup_rate_per_ip)
+
+    ssl_context = load_ssl_context()
+    token_signer = TokenSigner(load_secret(SESSION_SECRET_FILE, SESSION_SECRET_ENV))
+    if args.compress_level:
+        # In order of preference
+        compressors = {codec: Compressor(codec, args.compress_level, args.compress_threshold)
+                       for codec in available_codecs()}
+    connect_database()
+    message_writer = MessageWriter(messages_collection, PERSIST_MODE, PERSIST_BATCH_SIZE,
+                                   PERSIST_FLUSH_INTERVAL, PERSIST_QUEUE_SIZE)
+    migrate_timestamps()
+    recent_ids = load_recent_ids()
+    history_cache = load_history_cache()
+    search_index = load_search_index()
+    file_store = FileStore(FILE_STORE_DIR, MAX_FILE_SIZE, PARTIAL_QUOTA, PARTIAL_TTL)
+    presence = PresenceLog(publish_presence)
+    typing_aggregator = TypingAggregator(send_typing_update, args.typing_tick)
+    password_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+    # Start the workers now, before any listening socket exists for them to inherit
+    password_pool.submit(os.getpid).result()
+    # Treat SIGTERM like Ctrl+C so queued messages are flushed on the way out
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if METRICS_INTERVAL:
+        threading.Thread(target=report_metrics, daemon=True).start()
+    threading.Thread(target=typing_aggregator.run, name="typing", daemon=True).start()
+    bus = open_bus(BUS_ADDRESS, NODE_ID, announce_node)
+    bus.start(handle_bus_message)
+    threading.Thread(target=run_heartbeat, name="heartbeat", daemon=True).start()
+    threading.Thread(target=expire_partials, name="partials", daemon=True).start()
+
     try:
-        receive_connections()
+        if args.mode == "asyncio":
+            asyncio.run(serve_asyncio())
+        else:
+            run_threaded()
     except KeyboardInterrupt:
         print("\nShutting down server...")
     except Exception as e:
         print(f"Server error: {str(e)}")
     finally:
-        server.close()
+        password_pool.shutdown(cancel_futures=True)
+        bus.close()
+        print(f"💾 Flushing {message_writer.pending()} queued messages...")
+        message_writer.close()